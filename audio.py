@@ -1,12 +1,89 @@
-import librosa
-import librosa.filters
 import numpy as np
+import functools
+import hashlib
+import os
 # import tensorflow as tf
 from scipy import signal
+from scipy import fft
 from scipy.io import wavfile
 from hparams import hparams as hp
 
+# librosa is imported where it is used, it is slow to import and dataloader workers mostly
+# only need the native-rate wav path below.
+
 def load_wav(path, sr):
+    """Float32 mono samples of the audio file at ``path``, at sample rate ``sr``.
+
+    PCM wavs already at ``sr`` (what preprocess.py writes) are memory-mapped and converted
+    directly. Anything else goes through librosa, and the last resampled file is cached.
+    """
+    wav = _load_native_wav(path, sr)
+    if wav is not None:
+        return wav
+    st = os.stat(path)
+    return _load_wav_librosa(path, sr, st.st_size, st.st_mtime_ns).copy()
+
+def _load_native_wav(path, sr):
+    data = _native_wav_data(path, sr)
+    if data is None:
+        return None
+    return _pcm_to_float(data)
+
+def _pcm_to_float(data):
+    # Same scaling as soundfile, which librosa uses for wavs
+    if data.dtype == np.int16:
+        wav = data.astype(np.float32) / 32768.
+    elif data.dtype == np.int32:
+        wav = data.astype(np.float32) / 2147483648.
+    elif data.dtype == np.uint8:
+        wav = (data.astype(np.float32) - 128.) / 128.
+    elif data.dtype == np.float32:
+        wav = np.array(data)
+    else:
+        return None
+
+    if wav.ndim > 1:
+        wav = wav.mean(axis=1)
+    return wav
+
+def _native_wav_data(path, sr):
+    # Memory-mapped samples of a wav at ``sr`` that _pcm_to_float can convert, else None
+    try:
+        file_sr, data = wavfile.read(path, mmap=True)
+    except (ValueError, OSError):
+        return None
+    if file_sr != sr or data.dtype not in (np.int16, np.int32, np.uint8, np.float32):
+        return None
+    return data
+
+def wav_num_samples(path, sr):
+    """Number of samples load_wav(path, sr) returns, read from the header for native-rate wavs."""
+    data = _native_wav_data(path, sr)
+    if data is not None:
+        return len(data)
+    return len(load_wav(path, sr))
+
+def iter_wav_blocks(path, sr, block_size=160000):
+    """load_wav(path, sr) in float32 blocks of ``block_size`` samples.
+
+    Native-rate wavs are converted block by block from a memory map, so only one block is in
+    memory at a time. Other files are loaded (and resampled) whole first.
+    """
+    data = _native_wav_data(path, sr)
+    if data is None:
+        data = load_wav(path, sr)
+        for i in range(0, len(data), block_size):
+            yield data[i:i + block_size]
+        return
+    for i in range(0, len(data), block_size):
+        yield _pcm_to_float(data[i:i + block_size])
+
+@functools.lru_cache(maxsize=1)
+def _load_wav_librosa(path, sr, size, mtime_ns):
+    # size and mtime_ns are only part of the cache key. Only the last file is kept: it covers
+    # wav_num_samples followed by iter_wav_blocks on the same file, without holding on to
+    # whole waveforms of earlier files.
+    import librosa
     return librosa.core.load(path, sr=sr)[0]
 
 def save_wav(wav, path, sr):
@@ -15,11 +92,23 @@ def save_wav(wav, path, sr):
     wavfile.write(path, sr, wav.astype(np.int16))
 
 def save_wavenet_wav(wav, path, sr):
+    import librosa
     librosa.output.write_wav(path, wav, sr=sr)
 
-def preemphasis(wav, k, preemphasize=True):
+def preemphasis(wav, k, preemphasize=True, prev=0.):
+    """wav[t] - k * wav[t - 1], float32 for float32 or int16 input (lfilter would promote to float64).
+
+    ``prev`` is the sample before wav[0], for signals processed in pieces.
+    """
     if preemphasize:
-        return signal.lfilter([1, -k], [1], wav)
+        wav = np.asarray(wav)
+        out = np.empty(wav.shape, dtype=np.result_type(wav.dtype, np.float32))
+        if len(wav) == 0:
+            return out
+        np.multiply(wav[:-1], -k, out=out[1:])
+        out[1:] += wav[1:]
+        out[0] = wav[0] - k * prev
+        return out
     return wav
 
 def inv_preemphasis(wav, k, inv_preemphasize=True):
@@ -36,20 +125,245 @@ def get_hop_size():
 
 def linearspectrogram(wav):
     D = _stft(preemphasis(wav, hp.preemphasis, hp.preemphasize))
-    S = _amp_to_db(np.abs(D)) - hp.ref_level_db
+    S = _amp_to_db(np.abs(D))
+    S -= hp.ref_level_db
     
     if hp.signal_normalization:
         return _normalize(S)
     return S
 
 def melspectrogram(wav):
+    """(num_mels, T) mel spectrogram of ``wav``, float32 for float32 input (what load_wav returns)."""
     D = _stft(preemphasis(wav, hp.preemphasis, hp.preemphasize))
-    S = _amp_to_db(_linear_to_mel(np.abs(D))) - hp.ref_level_db
+    S = _amp_to_db(_linear_to_mel(np.abs(D)))
+    S -= hp.ref_level_db
     
     if hp.signal_normalization:
         return _normalize(S)
     return S
 
+def melspectrogram_batch(wavs, device=None):
+    """melspectrogram of a batch of equal-length waveforms in one pass, computed with torch.
+
+    ``wavs`` is a (B, num_samples) array or tensor. Shorter clips can be zero padded, their
+    first ``len(clip) // hop_size - 1`` frames are exact, only the frames that see the end
+    padding differ. Returns a (B, num_mels, T) tensor on ``device`` (default: the device of
+    ``wavs``), in float32 unless ``wavs`` is float64. Matches melspectrogram to ~1e-5 in float32.
+    Integer PCM (uint8, int16, int32, e.g. microphone buffers) is scaled to [-1, 1] like load_wav.
+    """
+    import torch
+    wavs = torch.as_tensor(wavs, device=device)
+    if not wavs.is_floating_point():
+        if wavs.dtype == torch.int16:
+            wavs = wavs.float() / 32768.
+        elif wavs.dtype == torch.int32:
+            wavs = wavs.float() / 2147483648.
+        elif wavs.dtype == torch.uint8:
+            wavs = (wavs.float() - 128.) / 128.
+        else:
+            raise ValueError('Unsupported sample type {}, expected float or 8/16/32-bit PCM'.format(wavs.dtype))
+    if wavs.dim() == 1:
+        wavs = wavs[None]
+
+    if hp.preemphasize:
+        # lfilter([1, -k], [1], wav) with zero initial state
+        wavs = torch.cat((wavs[:, :1], wavs[:, 1:] - hp.preemphasis * wavs[:, :-1]), dim=1)
+
+    win_size = hp.win_size if hp.win_size is not None else hp.n_fft
+    window = torch.hann_window(win_size, periodic=True, dtype=wavs.dtype, device=wavs.device)
+    D = torch.stft(wavs, n_fft=hp.n_fft, hop_length=get_hop_size(), win_length=win_size, window=window,
+                   center=True, pad_mode='reflect', return_complex=True)
+
+    S = _amp_to_db_torch(torch.matmul(_mel_basis_torch(wavs.dtype, wavs.device), D.abs())) - hp.ref_level_db
+    if hp.signal_normalization:
+        return _normalize_torch(S)
+    return S
+
+# Bump when the way melspectrogram computes its output changes, so stale caches are ignored
+_MEL_CACHE_VERSION = 2
+_MEL_HPARAMS = ['num_mels', 'n_fft', 'hop_size', 'win_size', 'sample_rate', 'frame_shift_ms', 'use_lws',
+                'signal_normalization', 'allow_clipping_in_normalization', 'symmetric_mels', 'max_abs_value',
+                'preemphasize', 'preemphasis', 'min_level_db', 'ref_level_db', 'fmin', 'fmax']
+
+def _mel_cache_path(wavpath):
+    st = os.stat(wavpath)
+    key = repr([_MEL_CACHE_VERSION, st.st_size, st.st_mtime_ns] + [hp.data.get(k) for k in _MEL_HPARAMS])
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(os.path.dirname(wavpath), 'mel_{}.npy'.format(digest))
+
+def cached_melspectrogram(wavpath):
+    """melspectrogram of the wav at ``wavpath``, computed once and memory-mapped afterwards.
+
+    The mel is saved next to the wav as mel_<key>.npy, where the key covers the wav size and
+    mtime and the audio hparams, so editing either one recomputes it. Returns a copy-on-write
+    (num_mels, T) array.
+    """
+    cache_path = _mel_cache_path(wavpath)
+    try:
+        return np.load(cache_path, mmap_mode='c')
+    except (IOError, ValueError):
+        pass
+
+    mel = melspectrogram(load_wav(wavpath, hp.sample_rate))
+    # Written under a unique name and renamed, dataloader workers may race on the same video
+    tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.save(f, mel)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # Read-only dataset, just use the computed mel
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        return mel
+    return np.load(cache_path, mmap_mode='c')
+
+def mel_num_frames(num_samples):
+    """Number of frames melspectrogram returns for ``num_samples`` samples (centered STFT)."""
+    return 1 + num_samples // get_hop_size()
+
+def mel_windows(mel, mel_step_size=16):
+    """Every window of ``mel_step_size`` consecutive frames of a (num_mels, T) mel.
+
+    Returns a (T - mel_step_size + 1, num_mels, mel_step_size) strided view, no data is copied.
+    Index it with ``mel_chunk_starts`` to get the chunk of each video frame.
+    """
+    if mel.shape[1] < mel_step_size:
+        return np.zeros((0, mel.shape[0], mel_step_size), dtype=mel.dtype)
+    return np.lib.stride_tricks.sliding_window_view(mel, mel_step_size, axis=1).transpose(1, 0, 2)
+
+def mel_chunk_starts(num_mel_frames, fps, mel_step_size=16, keep_tail=False, first_chunk=0):
+    """Start frame of the mel chunk of every video frame at ``fps``, from video frame ``first_chunk`` on.
+
+    Only chunks that fit in ``num_mel_frames`` are returned. With ``keep_tail`` a last chunk ending
+    at the final mel frame is added, as the inference scripts do.
+    """
+    mel_idx_multiplier = 80. / fps
+    num_chunks = int((num_mel_frames - mel_step_size) / mel_idx_multiplier) + 2
+    starts = (np.arange(first_chunk, max(first_chunk, num_chunks)) * mel_idx_multiplier).astype(np.int64)
+    starts = starts[starts + mel_step_size <= num_mel_frames]
+    if keep_tail and num_mel_frames >= mel_step_size:
+        starts = np.append(starts, num_mel_frames - mel_step_size)
+    return starts
+
+def gather_mel_windows(mel, starts, mel_step_size=16):
+    """(len(starts), num_mels, mel_step_size) windows of a (num_mels, T) mel in one indexing op.
+
+    Returns None if any window does not fit in the mel.
+    """
+    starts = np.asarray(starts)
+    if len(starts) and (starts.min() < 0 or starts.max() + mel_step_size > mel.shape[1]):
+        return None
+    return mel_windows(mel, mel_step_size)[starts]
+
+class StreamingMelSpectrogram:
+    """Incremental melspectrogram for audio that arrives in pieces (e.g. microphone windows).
+
+    Pre-emphasis filter state and the STFT overlap are carried across pushes, so concatenating
+    the output of every ``push`` followed by ``flush`` equals ``melspectrogram`` on the whole
+    signal, and each push only computes the frames that became complete.
+    """
+    def __init__(self):
+        import librosa
+        self.n_fft = hp.n_fft
+        self.hop_size = get_hop_size()
+        win_size = hp.win_size if hp.win_size is not None else hp.n_fft
+        self.window = librosa.util.pad_center(librosa.filters.get_window('hann', win_size, fftbins=True),
+                                              size=hp.n_fft).astype(np.float32)
+        self._prev = 0. # Last sample before pre-emphasis, the filter state
+        self._buffer = np.zeros(0, dtype=np.float32)
+        self._started = False
+
+    def push(self, wav):
+        """Adds samples and returns the newly completed mel frames, shape (num_mels, T_new)."""
+        wav = np.asarray(wav, dtype=np.float32)
+        if len(wav) == 0:
+            return self._empty()
+        if hp.preemphasize:
+            wav, self._prev = preemphasis(wav, hp.preemphasis, prev=self._prev), wav[-1]
+        self._buffer = np.concatenate((self._buffer, wav))
+        if not self._started:
+            # Same centering as librosa.stft, the first frame is centered on the first sample.
+            if len(self._buffer) <= self.n_fft // 2:
+                return self._empty()
+            self._buffer = np.pad(self._buffer, (self.n_fft // 2, 0), mode='reflect')
+            self._started = True
+        return self._emit()
+
+    def flush(self):
+        """Pads the end of the signal like librosa.stft and returns the remaining frames."""
+        if not self._started:
+            if len(self._buffer) == 0:
+                return self._empty()
+            self._buffer = np.pad(self._buffer, (self.n_fft // 2, 0), mode='reflect')
+            self._started = True
+        self._buffer = np.pad(self._buffer, (0, self.n_fft // 2), mode='reflect')
+        mel = self._emit()
+        self._buffer = np.zeros(0, dtype=np.float32)
+        return mel
+
+    def _empty(self):
+        return np.zeros((hp.num_mels, 0), dtype=np.float32)
+
+    def _emit(self):
+        if len(self._buffer) < self.n_fft:
+            return self._empty()
+        num_frames = 1 + (len(self._buffer) - self.n_fft) // self.hop_size
+        frames = np.lib.stride_tricks.sliding_window_view(self._buffer, self.n_fft)[::self.hop_size][:num_frames]
+        # scipy.fft keeps float32 in single precision, np.fft always computes in float64
+        D = fft.rfft(frames * self.window, axis=1).T
+        self._buffer = self._buffer[num_frames * self.hop_size:]
+
+        S = _amp_to_db(_linear_to_mel(np.abs(D))) - hp.ref_level_db
+        if hp.signal_normalization:
+            return _normalize(S)
+        return S
+
+class MelChunker:
+    """Cuts mel frames that arrive in pieces into the per-video-frame chunks at ``fps``.
+
+    Chunk i starts at mel frame int(i * 80 / fps), as in the inference scripts. Only the mel
+    frames that upcoming chunks still need are kept between pushes.
+    """
+    def __init__(self, fps, mel_step_size=16):
+        self.fps = fps
+        self.mel_step_size = mel_step_size
+        self.history = np.zeros((hp.num_mels, 0), dtype=np.float32) # Mel frames still needed by upcoming chunks
+        self.offset = 0 # Absolute mel frame index of history[:, 0]
+        self.chunk_idx = 0 # Absolute index of the next chunk (= next output video frame)
+
+    def push(self, mel):
+        """Adds (num_mels, T_new) mel frames and returns the completed chunks, shape (N, num_mels, mel_step_size)."""
+        self.history = np.concatenate((self.history, mel), axis=1)
+        starts = mel_chunk_starts(self.offset + self.history.shape[1], self.fps, self.mel_step_size,
+                                  first_chunk=self.chunk_idx)
+        chunks = mel_windows(self.history, self.mel_step_size)[starts - self.offset]
+        self.chunk_idx += len(starts)
+
+        next_start = int(self.chunk_idx * 80. / self.fps)
+        drop = min(next_start - self.offset, self.history.shape[1])
+        self.history = self.history[:, drop:]
+        self.offset += drop
+        return chunks
+
+class MelNaNError(ValueError):
+    """Raised when a melspectrogram contains nan, e.g. for some TTS voices."""
+
+def iter_mel_chunks(wav_blocks, fps, mel_step_size=16):
+    """Yields the (num_mels, mel_step_size) mel chunk of every video frame of a long audio.
+
+    ``wav_blocks`` is an iterable of float sample blocks, e.g. iter_wav_blocks. The chunks
+    are the same as slicing melspectrogram of the whole audio, but memory stays bounded by
+    the block size.
+    """
+    mel_stream = StreamingMelSpectrogram()
+    chunker = MelChunker(fps, mel_step_size)
+    for block in wav_blocks:
+        mel = mel_stream.push(block)
+        if np.isnan(mel.reshape(-1)).sum() > 0:
+            raise MelNaNError('Mel contains nan!')
+        yield from chunker.push(mel)
+    yield from chunker.push(mel_stream.flush())
+
 def _lws_processor():
     import lws
     return lws.lws(hp.n_fft, get_hop_size(), fftsize=hp.win_size, mode="speech")
@@ -58,6 +372,7 @@ def _stft(y):
     if hp.use_lws:
         return _lws_processor(hp).stft(y).T
     else:
+        import librosa
         return librosa.stft(y=y, n_fft=hp.n_fft, hop_length=get_hop_size(), win_length=hp.win_size)
 
 ##########################################################
@@ -96,24 +411,45 @@ def _linear_to_mel(spectogram):
     return np.dot(_mel_basis, spectogram)
 
 def _build_mel_basis():
+    import librosa
     assert hp.fmax <= hp.sample_rate // 2
     return librosa.filters.mel(hp.sample_rate, hp.n_fft, n_mels=hp.num_mels,
                                fmin=hp.fmin, fmax=hp.fmax)
 
 def _amp_to_db(x):
-    min_level = np.exp(hp.min_level_db / 20 * np.log(10))
-    return 20 * np.log10(np.maximum(min_level, x))
+    # Python float, a numpy float64 scalar would promote float32 input under NEP 50
+    min_level = float(np.exp(hp.min_level_db / 20 * np.log(10)))
+    S = np.maximum(x, min_level)
+    np.log10(S, out=S)
+    S *= 20
+    return S
+
+def _mel_basis_torch(dtype, device):
+    import torch
+    global _mel_basis
+    if _mel_basis is None:
+        _mel_basis = _build_mel_basis()
+    return torch.as_tensor(_mel_basis, dtype=dtype, device=device)
+
+def _amp_to_db_torch(x):
+    min_level = float(np.exp(hp.min_level_db / 20 * np.log(10)))
+    return 20 * x.clamp(min=min_level).log10()
 
 def _db_to_amp(x):
     return np.power(10.0, (x) * 0.05)
 
 def _normalize(S):
     if hp.allow_clipping_in_normalization:
+        # Same arithmetic as below, in one output buffer
+        out = S - hp.min_level_db
+        out /= -hp.min_level_db
         if hp.symmetric_mels:
-            return np.clip((2 * hp.max_abs_value) * ((S - hp.min_level_db) / (-hp.min_level_db)) - hp.max_abs_value,
-                           -hp.max_abs_value, hp.max_abs_value)
+            out *= 2 * hp.max_abs_value
+            out -= hp.max_abs_value
+            return np.clip(out, -hp.max_abs_value, hp.max_abs_value, out=out)
         else:
-            return np.clip(hp.max_abs_value * ((S - hp.min_level_db) / (-hp.min_level_db)), 0, hp.max_abs_value)
+            out *= hp.max_abs_value
+            return np.clip(out, 0, hp.max_abs_value, out=out)
     
     assert S.max() <= 0 and S.min() - hp.min_level_db >= 0
     if hp.symmetric_mels:
@@ -121,6 +457,20 @@ def _normalize(S):
     else:
         return hp.max_abs_value * ((S - hp.min_level_db) / (-hp.min_level_db))
 
+def _normalize_torch(S):
+    if hp.allow_clipping_in_normalization:
+        if hp.symmetric_mels:
+            return ((2 * hp.max_abs_value) * ((S - hp.min_level_db) / (-hp.min_level_db)) - hp.max_abs_value
+                    ).clamp(-hp.max_abs_value, hp.max_abs_value)
+        else:
+            return (hp.max_abs_value * ((S - hp.min_level_db) / (-hp.min_level_db))).clamp(0, hp.max_abs_value)
+
+    assert S.max() <= 0 and S.min() - hp.min_level_db >= 0
+    if hp.symmetric_mels:
+        return (2 * hp.max_abs_value) * ((S - hp.min_level_db) / (-hp.min_level_db)) - hp.max_abs_value
+    else:
+        return hp.max_abs_value * ((S - hp.min_level_db) / (-hp.min_level_db))
+
 def _denormalize(D):
     if hp.allow_clipping_in_normalization:
         if hp.symmetric_mels:
@@ -9,7 +9,7 @@ import torch
 sys.path.append('../')
 import audio
 import face_detection
-from models import Wav2Lip
+from models import Wav2Lip, fuse_for_inference
 
 parser = argparse.ArgumentParser(description='Code to generate results for test filelists')
 
@@ -32,15 +32,6 @@ parser.add_argument('--wav2lip_batch_size', type=int, help='Batch size for Wav2L
 args = parser.parse_args()
 args.img_size = 96
 
-def get_smoothened_boxes(boxes, T):
-	for i in range(len(boxes)):
-		if i + T > len(boxes):
-			window = boxes[len(boxes) - T:]
-		else:
-			window = boxes[i : i + T]
-		boxes[i] = np.mean(window, axis=0)
-	return boxes
-
 def face_detect(images):
 	batch_size = args.face_det_batch_size
 	
@@ -71,7 +62,7 @@ def face_detect(images):
 		
 		results.append([x1, y1, x2, y2])
 
-	boxes = get_smoothened_boxes(np.array(results), T=5)
+	boxes = face_detection.smooth_boxes(np.array(results), T=5)
 	results = [[image[y1: y2, x1:x2], (y1, y2, x1, x2), True] for image, (x1, y1, x2, y2) in zip(images, boxes)]
 
 	return results 
@@ -119,7 +110,6 @@ def datagen(frames, face_det_results, mels):
 
 fps = 25
 mel_step_size = 16
-mel_idx_multiplier = 80./fps
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 print('Using {} for inference.'.format(device))
 
@@ -145,7 +135,7 @@ def load_model(path):
 	model.load_state_dict(new_s)
 
 	model = model.to(device)
-	return model.eval()
+	return fuse_for_inference(model)
 
 model = load_model(args.checkpoint_path)
 
@@ -164,38 +154,27 @@ def main():
 		audio_src = os.path.join(data_root, audio_src) + '.mp4'
 		video = os.path.join(data_root, video) + '.mp4'
 
-		command = 'ffmpeg -loglevel panic -y -i {} -strict -2 {}'.format(audio_src, '../temp/temp.wav')
+		command = 'ffmpeg -loglevel panic -y -i {} -strict -2 -ar 16000 -ac 1 {}'.format(audio_src, '../temp/temp.wav')
 		subprocess.call(command, shell=True)
 		temp_audio = '../temp/temp.wav'
 
-		wav = audio.load_wav(temp_audio, 16000)
-		mel = audio.melspectrogram(wav)
-		if np.isnan(mel.reshape(-1)).sum() > 0:
-			continue
-
-		mel_chunks = []
-		i = 0
-		while 1:
-			start_idx = int(i * mel_idx_multiplier)
-			if start_idx + mel_step_size > len(mel[0]):
-				break
-			mel_chunks.append(mel[:, start_idx : start_idx + mel_step_size])
-			i += 1
+		num_mel_frames = audio.mel_num_frames(audio.wav_num_samples(temp_audio, 16000))
+		num_chunks = len(audio.mel_chunk_starts(num_mel_frames, fps, mel_step_size))
 
 		video_stream = cv2.VideoCapture(video)
 			
 		full_frames = []
 		while 1:
 			still_reading, frame = video_stream.read()
-			if not still_reading or len(full_frames) > len(mel_chunks):
+			if not still_reading or len(full_frames) > num_chunks:
 				video_stream.release()
 				break
 			full_frames.append(frame)
 
-		if len(full_frames) < len(mel_chunks):
+		if len(full_frames) < num_chunks:
 			continue
 
-		full_frames = full_frames[:len(mel_chunks)]
+		full_frames = full_frames[:num_chunks]
 
 		try:
 			face_det_results = face_detect(full_frames.copy())
@@ -203,28 +182,36 @@ def main():
 			continue
 
 		batch_size = args.wav2lip_batch_size
+		mel_chunks = audio.iter_mel_chunks(audio.iter_wav_blocks(temp_audio, 16000), fps, mel_step_size)
 		gen = datagen(full_frames.copy(), face_det_results, mel_chunks)
 
-		for i, (img_batch, mel_batch, frames, coords) in enumerate(gen):
-			if i == 0:
-				frame_h, frame_w = full_frames[0].shape[:-1]
-				out = cv2.VideoWriter('../temp/result.avi', 
-								cv2.VideoWriter_fourcc(*'DIVX'), fps, (frame_w, frame_h))
+		out = None
+		try:
+			for i, (img_batch, mel_batch, frames, coords) in enumerate(gen):
+				if i == 0:
+					frame_h, frame_w = full_frames[0].shape[:-1]
+					out = cv2.VideoWriter('../temp/result.avi', 
+									cv2.VideoWriter_fourcc(*'DIVX'), fps, (frame_w, frame_h))
 
-			img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(device)
-			mel_batch = torch.FloatTensor(np.transpose(mel_batch, (0, 3, 1, 2))).to(device)
+				img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(device)
+				mel_batch = torch.FloatTensor(np.transpose(mel_batch, (0, 3, 1, 2))).to(device)
 
-			with torch.no_grad():
-				pred = model(mel_batch, img_batch)
+				with torch.no_grad():
+					pred = model(mel_batch, img_batch)
 					
 
-			pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
+				pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
 			
-			for pl, f, c in zip(pred, frames, coords):
-				y1, y2, x1, x2 = c
-				pl = cv2.resize(pl.astype(np.uint8), (x2 - x1, y2 - y1))
-				f[y1:y2, x1:x2] = pl
-				out.write(f)
+				for pl, f, c in zip(pred, frames, coords):
+					y1, y2, x1, x2 = c
+					pl = cv2.resize(pl.astype(np.uint8), (x2 - x1, y2 - y1))
+					f[y1:y2, x1:x2] = pl
+					out.write(f)
+		except audio.MelNaNError:
+			# Found while streaming the chunks, skip this pair like a failed face detection
+			print('Mel contains nan, skipping {}'.format(audio_src))
+			if out is not None: out.release()
+			continue
 
 		out.release()
 
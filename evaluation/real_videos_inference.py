@@ -9,7 +9,7 @@ import torch
 sys.path.append('../')
 import audio
 import face_detection
-from models import Wav2Lip
+from models import Wav2Lip, fuse_for_inference
 
 parser = argparse.ArgumentParser(description='Code to generate results on ReSyncED evaluation set')
 
@@ -39,15 +39,6 @@ parser.add_argument('--max_frame_res', help='Downsample to at least this frame r
 args = parser.parse_args()
 args.img_size = 96
 
-def get_smoothened_boxes(boxes, T):
-	for i in range(len(boxes)):
-		if i + T > len(boxes):
-			window = boxes[len(boxes) - T:]
-		else:
-			window = boxes[i : i + T]
-		boxes[i] = np.mean(window, axis=0)
-	return boxes
-
 def rescale_frames(images):
 	rect = detector.get_detections_for_batch(np.array([images[0]]))[0]
 	if rect is None:
@@ -100,7 +91,7 @@ def face_detect(images):
 		
 		results.append([x1, y1, x2, y2])
 
-	boxes = get_smoothened_boxes(np.array(results), T=5)
+	boxes = face_detection.smooth_boxes(np.array(results), T=5)
 	results = [[image[y1: y2, x1:x2], (y1, y2, x1, x2), True] for image, (x1, y1, x2, y2) in zip(images, boxes)]
 
 	return results, images 
@@ -192,7 +183,7 @@ def load_model(path):
 	model.load_state_dict(new_s)
 
 	model = model.to(device)
-	return model.eval()
+	return fuse_for_inference(model)
 
 model = load_model(args.checkpoint_path)
 
@@ -214,20 +205,13 @@ def main():
 		audio_src = os.path.join(args.data_root, audio_src)
 		video = os.path.join(args.data_root, video)
 
-		command = 'ffmpeg -loglevel panic -y -i {} -strict -2 {}'.format(audio_src, '../temp/temp.wav')
+		command = 'ffmpeg -loglevel panic -y -i {} -strict -2 -ar 16000 -ac 1 {}'.format(audio_src, '../temp/temp.wav')
 		subprocess.call(command, shell=True)
 		temp_audio = '../temp/temp.wav'
 
-		wav = audio.load_wav(temp_audio, 16000)
-		mel = audio.melspectrogram(wav)
-
-		if np.isnan(mel.reshape(-1)).sum() > 0:
-			raise ValueError('Mel contains nan!')
-
 		video_stream = cv2.VideoCapture(video)
 
 		fps = video_stream.get(cv2.CAP_PROP_FPS)
-		mel_idx_multiplier = 80./fps
 
 		full_frames = []
 		while 1:
@@ -245,23 +229,17 @@ def main():
 				frame = cv2.resize(frame, (w, h))
 			full_frames.append(frame)
 
-		mel_chunks = []
-		i = 0
-		while 1:
-			start_idx = int(i * mel_idx_multiplier)
-			if start_idx + mel_step_size > len(mel[0]):
-				break
-			mel_chunks.append(mel[:, start_idx : start_idx + mel_step_size])
-			i += 1
+		num_mel_frames = audio.mel_num_frames(audio.wav_num_samples(temp_audio, 16000))
+		num_chunks = len(audio.mel_chunk_starts(num_mel_frames, fps, mel_step_size))
 
-		if len(full_frames) < len(mel_chunks):
+		if len(full_frames) < num_chunks:
 			if args.mode == 'tts':
-				full_frames = increase_frames(full_frames, len(mel_chunks))
+				full_frames = increase_frames(full_frames, num_chunks)
 			else:
 				raise ValueError('#Frames, audio length mismatch')
 
 		else:
-			full_frames = full_frames[:len(mel_chunks)]
+			full_frames = full_frames[:num_chunks]
 
 		try:
 			face_det_results, full_frames = face_detect(full_frames.copy())
@@ -269,6 +247,7 @@ def main():
 			continue
 
 		batch_size = args.wav2lip_batch_size
+		mel_chunks = audio.iter_mel_chunks(audio.iter_wav_blocks(temp_audio, 16000), fps, mel_step_size)
 		gen = datagen(full_frames.copy(), face_det_results, mel_chunks)
 
 		for i, (img_batch, mel_batch, frames, coords) in enumerate(gen):
@@ -5,3 +5,5 @@ __email__ = 'adrian.bulat@nottingham.ac.uk'
 __version__ = '1.0.1'
 
 from .api import FaceAlignment, LandmarksType, NetworkSize
+from .smoothing import smooth_boxes, OnlineBoxSmoother
+from .detection import DETECTORS, load_detector, DetectionBatchSizer, detection_scale, resize_for_detection
\ No newline at end of file
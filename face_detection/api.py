@@ -12,6 +12,7 @@ except BaseException:
 
 from .models import FAN, ResNetDepth
 from .utils import *
+from .detection import load_detector, resize_for_detection
 
 
 class LandmarksType(Enum):
@@ -45,7 +46,7 @@ ROOT = os.path.dirname(os.path.abspath(__file__))
 
 class FaceAlignment:
     def __init__(self, landmarks_type, network_size=NetworkSize.LARGE,
-                 device='cuda', flip_input=False, face_detector='sfd', verbose=False):
+                 device='cuda', flip_input=False, face_detector='sfd', verbose=False, detector_dtype='float32'):
         self.device = device
         self.flip_input = flip_input
         self.landmarks_type = landmarks_type
@@ -57,23 +58,43 @@ class FaceAlignment:
             torch.backends.cudnn.benchmark = True
 
         # Get the face detector
-        face_detector_module = __import__('face_detection.detection.' + face_detector,
-                                          globals(), locals(), [face_detector], 0)
-        self.face_detector = face_detector_module.FaceDetector(device=device, verbose=verbose)
-
-    def get_detections_for_batch(self, images):
-        images = images[..., ::-1]
-        detected_faces = self.face_detector.detect_from_batch(images.copy())
-        results = []
-
-        for i, d in enumerate(detected_faces):
-            if len(d) == 0:
-                results.append(None)
-                continue
-            d = d[0]
-            d = np.clip(d, 0, None)
-            
-            x1, y1, x2, y2 = map(int, d[:-1])
-            results.append((x1, y1, x2, y2))
-
-        return results
\ No newline at end of file
+        self.face_detector = load_detector(face_detector, device=device, verbose=verbose, dtype=detector_dtype)
+
+    def get_detections_for_batch(self, images, short_side=None, refine=False):
+        """Best face box (x1, y1, x2, y2) of every BGR image of the batch, None where no face was found.
+
+        With ``short_side`` the detector runs on the batch resized so its shorter side is
+        ``short_side`` pixels, and boxes are mapped back to full resolution. ``refine`` then
+        re-detects at full resolution in a crop around every box.
+        """
+        detect_images, scale = resize_for_detection(images, short_side)
+        detected_faces, counts = self.face_detector.detect_batch(np.asarray(detect_images))
+        # Best box of every image
+        boxes = detected_faces[:, 0, :-1] / scale
+        found = counts > 0
+        if refine and scale != 1. and found.any():
+            boxes[found] = self._refine_detections(images[found], boxes[found])
+
+        boxes = np.clip(boxes, 0, None).astype(int)
+        results = [tuple(map(int, box)) if f else None for box, f in zip(boxes, found)]
+
+        return results
+
+    def _refine_detections(self, images, boxes, margin=0.25):
+        # Crops around each box, widened by margin * box size per side, zero padded to a common
+        # size so they run as one full-resolution batch. Boxes without a detection in their crop
+        # are kept as they are.
+        h, w = images.shape[1:3]
+        bw, bh = boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]
+        x1 = np.clip(boxes[:, 0] - margin * bw, 0, w).astype(int)
+        y1 = np.clip(boxes[:, 1] - margin * bh, 0, h).astype(int)
+        x2 = np.clip(boxes[:, 2] + margin * bw, 0, w).astype(int)
+        y2 = np.clip(boxes[:, 3] + margin * bh, 0, h).astype(int)
+
+        crops = np.zeros((len(images), (y2 - y1).max(), (x2 - x1).max(), 3), dtype=images.dtype)
+        for i, image in enumerate(images):
+            crops[i, :y2[i] - y1[i], :x2[i] - x1[i]] = image[y1[i]:y2[i], x1[i]:x2[i]]
+
+        detected_faces, counts = self.face_detector.detect_batch(crops)
+        refined = detected_faces[:, 0, :-1] + np.stack([x1, y1, x1, y1], 1)
+        return np.where((counts > 0)[:, None], refined, boxes)
\ No newline at end of file
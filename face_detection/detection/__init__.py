@@ -1 +1,3 @@
-from .core import FaceDetector
\ No newline at end of file
+from .core import FaceDetector
+from .registry import DETECTORS, load_detector
+from .batching import DetectionBatchSizer, detection_scale, resize_for_detection
\ No newline at end of file
@@ -0,0 +1,95 @@
+import os
+
+import cv2
+import numpy as np
+import torch
+
+
+def free_memory(device):
+    """Free memory in bytes on ``device``, available physical memory for the CPU."""
+    if 'cuda' in device:
+        free, _ = torch.cuda.mem_get_info(torch.device(device))
+        return free
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return 4 << 30
+
+
+def detection_scale(frame_shape, short_side):
+    """Scale factor and (h, w) of a frame resized so its shorter side is at most ``short_side``."""
+    h, w = frame_shape[:2]
+    if short_side is None or min(h, w) <= short_side:
+        return 1., (h, w)
+    scale = short_side / float(min(h, w))
+    return scale, (int(round(h * scale)), int(round(w * scale)))
+
+
+def resize_for_detection(images, short_side):
+    """``images`` resized per ``detection_scale`` for the detector, and the scale factor applied."""
+    if len(images) == 0:
+        return images, 1.
+    scale, (h, w) = detection_scale(images[0].shape, short_side)
+    if scale == 1.:
+        return images, 1.
+    return [cv2.resize(image, (w, h), interpolation=cv2.INTER_AREA) for image in images], scale
+
+
+def is_out_of_memory(error):
+    return isinstance(error, MemoryError) or 'out of memory' in str(error) or "can't allocate memory" in str(error)
+
+
+class DetectionBatchSizer:
+    """Face detection batch size sized from the frame resolution and a memory budget.
+
+    The first ``run`` picks the largest batch whose estimated detector memory
+    (``detector.batch_memory_per_pixel`` per input pixel) fits in ``memory_fraction`` of the
+    free device memory, capped at ``max_batch_size``. A batch that still runs out of memory is
+    retried at half the size, and the smaller size is kept for later runs.
+    """
+
+    def __init__(self, detector, device, batch_size=None, max_batch_size=512, memory_fraction=0.5, verbose=True):
+        self.detector = detector
+        self.device = device
+        self.batch_size = batch_size
+        self.max_batch_size = max_batch_size
+        self.memory_fraction = memory_fraction
+        self.verbose = verbose
+
+    def size_for(self, frame_shape):
+        h, w = frame_shape[:2]
+        budget = self.memory_fraction * free_memory(self.device)
+        batch_size = int(budget // (h * w * self.detector.batch_memory_per_pixel))
+        return int(np.clip(batch_size, 1, self.max_batch_size))
+
+    def run(self, detect, images, frame_shape=None):
+        """Yields the per-image results of ``detect(batch)`` over ``images``, batch by batch.
+
+        ``frame_shape`` is the shape of the frames the detector actually sees, if ``detect``
+        resizes them (default: the shape of ``images[0]``).
+        """
+        if len(images) == 0:
+            return
+        if self.batch_size is None:
+            self.batch_size = self.size_for(frame_shape if frame_shape is not None else images[0].shape)
+            if self.verbose:
+                print('Face detection batch size: {}'.format(self.batch_size))
+
+        i = 0
+        while i < len(images):
+            batch = images[i:i + self.batch_size]
+            try:
+                results = detect(batch)
+            except (RuntimeError, MemoryError) as e:
+                if not is_out_of_memory(e):
+                    raise
+                if self.batch_size == 1:
+                    raise RuntimeError('Image too big to run face detection on {}'.format(self.device))
+                if 'cuda' in self.device:
+                    torch.cuda.empty_cache()
+                self.batch_size //= 2
+                if self.verbose:
+                    print('Recovering from OOM error; New batch size: {}'.format(self.batch_size))
+                continue
+            yield from results
+            i += len(batch)
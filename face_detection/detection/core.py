@@ -51,6 +51,18 @@ class FaceDetector(object):
         """
         raise NotImplementedError
 
+    def detect_batch(self, images):
+        """Detects faces in a batch of images, the interface shared by all registered detectors.
+
+        Arguments:
+            images {numpy.ndarray} -- uint8 BGR images of shape [B, H, W, 3]
+
+        Returns:
+            (boxes, counts) -- float32 [B, K, 5] x1, y1, x2, y2, score of the faces of every image,
+            best first and zero padded, and the int [B] number of faces of every image.
+        """
+        raise NotImplementedError
+
     def detect_from_directory(self, path, extensions=['.jpg', '.png'], recursive=False, show_progress_bar=True):
         """Detects faces from all the images present in a given directory.
 
@@ -100,6 +112,11 @@ class FaceDetector(object):
 
         return predictions
 
+    @property
+    def batch_memory_per_pixel(self):
+        """Rough detector memory in bytes per input pixel, used to size detection batches."""
+        return 1024
+
     @property
     def reference_scale(self):
         raise NotImplementedError
@@ -0,0 +1,27 @@
+import importlib
+
+# Detector name -> package providing it as ``FaceDetector``. Packages are imported on first use,
+# so a detector's dependencies are only needed when it is selected.
+DETECTORS = {
+    'sfd': 'face_detection.detection.sfd',
+    'retinaface': 'face_detection.detection.retinaface',
+}
+
+
+def load_detector(name, device, **kwargs):
+    """Creates the face detector registered as ``name``.
+
+    Every detector implements ``FaceDetector.detect_batch``: a uint8 BGR batch of shape
+    [B, H, W, 3] in, zero padded [B, K, 5] (x1, y1, x2, y2, score) boxes, best first, and the
+    number of faces per image out.
+
+    Arguments:
+        name {string} -- one of ``DETECTORS``
+        device {string} -- 'cpu' or 'cuda[:index]'
+
+    Keyword arguments are passed on to the detector.
+    """
+    if name not in DETECTORS:
+        raise ValueError("Unknown face detector '{}', expected one of: {}".format(name, ', '.join(DETECTORS)))
+    module = importlib.import_module(DETECTORS[name])
+    return module.FaceDetector(device=device, **kwargs)
@@ -0,0 +1 @@
+from .retinaface_detector import RetinaFaceDetector as FaceDetector
\ No newline at end of file
@@ -0,0 +1,40 @@
+import numpy as np
+
+from ..core import FaceDetector
+
+
+class RetinaFaceDetector(FaceDetector):
+    """RetinaFace from the ``batch_face`` package behind the ``FaceDetector`` interface."""
+
+    def __init__(self, device, path_to_detector='checkpoints/mobilenet.pth', network='mobilenet', verbose=False,
+                 dtype='float32'):
+        super(RetinaFaceDetector, self).__init__(device, verbose)
+        if dtype not in ('float32', None):
+            raise ValueError('RetinaFace only runs in float32, got {}'.format(dtype))
+
+        from batch_face import RetinaFace
+        gpu_id = -1 if 'cpu' in device else int(device.split(':')[1]) if ':' in device else 0
+        self.face_detector = RetinaFace(gpu_id=gpu_id, model_path=path_to_detector, network=network)
+
+    def detect_from_image(self, tensor_or_path):
+        image = self.tensor_or_path_to_ndarray(tensor_or_path, rgb=False)
+        bboxlists, counts = self.detect_batch(image[None])
+        return list(bboxlists[0, :counts[0]])
+
+    @property
+    def batch_memory_per_pixel(self):
+        # The mobilenet backbone starts at stride 2 with few channels
+        return 128
+
+    def detect_batch(self, images):
+        faces = self.face_detector(list(images))
+        counts = np.array([len(f) for f in faces], dtype=np.int64)
+        bboxlists = np.zeros((len(images), max(int(counts.max()) if len(counts) else 0, 1), 5), dtype=np.float32)
+        for i, f in enumerate(faces):
+            # (box, landmarks, score) per face
+            f = sorted(f, key=lambda face: -face[2])
+            for j, (box, _, score) in enumerate(f):
+                bboxlists[i, j, :4] = box
+                bboxlists[i, j, 4] = score
+
+        return bboxlists, counts
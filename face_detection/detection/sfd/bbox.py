@@ -64,6 +64,57 @@ def nms(dets, thresh):
     return keep
 
 
+def batch_nms(dets, thresh, score_thresh=0.5, top_k=750, max_pairs=1 << 22):
+    """``nms`` followed by the ``score > score_thresh`` filter, for a whole batch at once.
+
+    Boxes at or below ``score_thresh`` can only suppress boxes that are filtered out anyway,
+    so they are dropped before NMS, and at most the ``top_k`` best boxes per image are kept.
+    The pairwise IoU matrices are built for chunks of images holding at most ``max_pairs``
+    box pairs, so memory stays bounded for large batches.
+    Args:
+        dets: (array or tensor) x1, y1, x2, y2, score of every candidate box.
+            Shape: [batch, num_boxes, 5].
+    Return:
+        kept boxes per image in descending score order, zero padded, Shape: [batch, K, 5]
+        with K >= 1, and the number of kept boxes per image, Shape: [batch].
+    """
+    dets = torch.as_tensor(dets)
+    B = dets.size(0)
+    valid = dets[:, :, 4] > score_thresh
+    k = min(top_k, int(valid.sum(1).max())) if dets.size(1) > 0 else 0
+    if k == 0:
+        return np.zeros((B, 1, 5), dtype=np.float32), np.zeros(B, dtype=np.int64)
+
+    scores, order = dets[:, :, 4].masked_fill(~valid, -1).topk(k, dim=1)
+    boxes = dets.gather(1, order.unsqueeze(2).expand(-1, -1, 5))
+    keep = scores > score_thresh
+    step = max(1, max_pairs // (k * k))
+    for start in range(0, B, step):
+        _greedy_nms(boxes[start:start + step], keep[start:start + step], thresh)
+
+    counts = keep.sum(1)
+    first = torch.sort((~keep).int(), dim=1, stable=True)[1]
+    boxes = boxes.gather(1, first.unsqueeze(2).expand(-1, -1, 5))
+    K = max(int(counts.max()), 1)
+    boxes = boxes[:, :K] * (torch.arange(K)[None, :] < counts[:, None]).unsqueeze(2)
+    return boxes.numpy(), counts.numpy()
+
+
+def _greedy_nms(boxes, keep, thresh):
+    # Clears ``keep`` (in place) for boxes suppressed by a higher scoring kept box, boxes in score order
+    x1, y1, x2, y2 = boxes[:, :, 0], boxes[:, :, 1], boxes[:, :, 2], boxes[:, :, 3]
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    xx1, yy1 = torch.max(x1[:, :, None], x1[:, None, :]), torch.max(y1[:, :, None], y1[:, None, :])
+    xx2, yy2 = torch.min(x2[:, :, None], x2[:, None, :]), torch.min(y2[:, :, None], y2[:, None, :])
+    w, h = (xx2 - xx1 + 1).clamp(min=0), (yy2 - yy1 + 1).clamp(min=0)
+    ovr = w * h / (areas[:, :, None] + areas[:, None, :] - w * h)
+    suppress = ovr > thresh
+
+    # Greedy pass in score order, box i only suppresses later boxes if it is still kept itself
+    for i in range(keep.size(1) - 1):
+        keep[:, i + 1:] &= ~(suppress[:, i, i + 1:] & keep[:, i:i + 1])
+
+
 def encode(matched, priors, variances):
     """Encode the variances from the priorbox layers into the ground truth boxes
     we have matched (based on jaccard overlap) with the prior boxes.
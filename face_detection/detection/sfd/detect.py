@@ -16,78 +16,84 @@ from .net_s3fd import s3fd
 from .bbox import *
 
 
-def detect(net, img, device):
-    img = img - np.array([104, 117, 123])
-    img = img.transpose(2, 0, 1)
-    img = img.reshape((1,) + img.shape)
-
+_prior_grids = {}
+
+
+def _prior_grid(feature_sizes, device):
+    """Priors (axc, ayc, aww, ahh) of every position of every S3FD feature map, concatenated in
+    level, row, column order. Built once per input resolution and device.
+    """
+    key = (tuple(feature_sizes), str(device))
+    if key not in _prior_grids:
+        priors = []
+        for i, (FH, FW) in enumerate(feature_sizes):
+            stride = 2**(i + 2)    # 4,8,16,32,64,128
+            hindex, windex = torch.meshgrid(torch.arange(FH), torch.arange(FW), indexing='ij')
+            axc, ayc = stride / 2 + windex.reshape(-1) * stride, stride / 2 + hindex.reshape(-1) * stride
+            anchor = torch.full_like(axc, stride * 4)
+            priors.append(torch.stack([axc, ayc, anchor, anchor], 1).float())
+        _prior_grids[key] = torch.cat(priors).to(device)
+    return _prior_grids[key]
+
+
+def decode_detections(olist):
+    """Boxes and scores of every anchor whose face score is above 0.05 in any image of the batch.
+
+    ``olist`` is the raw s3fd output. Returns a (num_candidates, batch, 5) array of
+    x1, y1, x2, y2, score, decoded in one tensor operation for all feature maps.
+    """
+    olist = [oelem.float() for oelem in olist]
+    BB = olist[0].size(0)
+    ocls = torch.cat([F.softmax(olist[i * 2], dim=1)[:, 1].reshape(BB, -1) for i in range(len(olist) // 2)], 1)
+    oreg = torch.cat([olist[i * 2 + 1].reshape(BB, 4, -1) for i in range(len(olist) // 2)], 2)
+    priors = _prior_grid([olist[i * 2].shape[2:] for i in range(len(olist) // 2)], ocls.device)
+
+    poss = (ocls > 0.05).any(0).nonzero()[:, 0]
+    loc = oreg[:, :, poss].transpose(1, 2)
+    variances = [0.1, 0.2]
+    box = batch_decode(loc, priors[poss].unsqueeze(0), variances)
+    bboxlist = torch.cat([box, ocls[:, poss].unsqueeze(2)], 2).transpose(0, 1)
+    return bboxlist.cpu().numpy()
+
+
+def to_network_input(imgs, device, dtype=torch.float32):
+    """(B, H, W, 3) BGR images to the mean-subtracted NCHW input of s3fd.
+
+    The images are moved to the device in their own dtype (uint8 for video frames), the
+    conversion and mean subtraction happen there. Reduced precision inputs are channels-last.
+    """
+    imgs = torch.from_numpy(np.ascontiguousarray(imgs)).to(device)
+    mean = torch.tensor([104, 117, 123], dtype=dtype, device=imgs.device).view(1, 3, 1, 1)
+    imgs = imgs.permute(0, 3, 1, 2).to(dtype) - mean
+    memory_format = torch.contiguous_format if dtype == torch.float32 else torch.channels_last
+    return imgs.contiguous(memory_format=memory_format)
+
+
+def detect(net, img, device, dtype=torch.float32):
     if 'cuda' in device:
         torch.backends.cudnn.benchmark = True
 
-    img = torch.from_numpy(img).float().to(device)
+    img = to_network_input(img[None], device, dtype)
     BB, CC, HH, WW = img.size()
     with torch.no_grad():
         olist = net(img)
+        bboxlist = decode_detections(olist)[:, 0]
 
-    bboxlist = []
-    for i in range(len(olist) // 2):
-        olist[i * 2] = F.softmax(olist[i * 2], dim=1)
-    olist = [oelem.data.cpu() for oelem in olist]
-    for i in range(len(olist) // 2):
-        ocls, oreg = olist[i * 2], olist[i * 2 + 1]
-        FB, FC, FH, FW = ocls.size()  # feature map size
-        stride = 2**(i + 2)    # 4,8,16,32,64,128
-        anchor = stride * 4
-        poss = zip(*np.where(ocls[:, 1, :, :] > 0.05))
-        for Iindex, hindex, windex in poss:
-            axc, ayc = stride / 2 + windex * stride, stride / 2 + hindex * stride
-            score = ocls[0, 1, hindex, windex]
-            loc = oreg[0, :, hindex, windex].contiguous().view(1, 4)
-            priors = torch.Tensor([[axc / 1.0, ayc / 1.0, stride * 4 / 1.0, stride * 4 / 1.0]])
-            variances = [0.1, 0.2]
-            box = decode(loc, priors, variances)
-            x1, y1, x2, y2 = box[0] * 1.0
-            # cv2.rectangle(imgshow,(int(x1),int(y1)),(int(x2),int(y2)),(0,0,255),1)
-            bboxlist.append([x1, y1, x2, y2, score])
-    bboxlist = np.array(bboxlist)
     if 0 == len(bboxlist):
         bboxlist = np.zeros((1, 5))
 
     return bboxlist
 
-def batch_detect(net, imgs, device):
-    imgs = imgs - np.array([104, 117, 123])
-    imgs = imgs.transpose(0, 3, 1, 2)
-
+def batch_detect(net, imgs, device, dtype=torch.float32):
     if 'cuda' in device:
         torch.backends.cudnn.benchmark = True
 
-    imgs = torch.from_numpy(imgs).float().to(device)
+    imgs = to_network_input(imgs, device, dtype)
     BB, CC, HH, WW = imgs.size()
     with torch.no_grad():
         olist = net(imgs)
+        bboxlist = decode_detections(olist)
 
-    bboxlist = []
-    for i in range(len(olist) // 2):
-        olist[i * 2] = F.softmax(olist[i * 2], dim=1)
-    olist = [oelem.data.cpu() for oelem in olist]
-    for i in range(len(olist) // 2):
-        ocls, oreg = olist[i * 2], olist[i * 2 + 1]
-        FB, FC, FH, FW = ocls.size()  # feature map size
-        stride = 2**(i + 2)    # 4,8,16,32,64,128
-        anchor = stride * 4
-        poss = zip(*np.where(ocls[:, 1, :, :] > 0.05))
-        for Iindex, hindex, windex in poss:
-            axc, ayc = stride / 2 + windex * stride, stride / 2 + hindex * stride
-            score = ocls[:, 1, hindex, windex]
-            loc = oreg[:, :, hindex, windex].contiguous().view(BB, 1, 4)
-            priors = torch.Tensor([[axc / 1.0, ayc / 1.0, stride * 4 / 1.0, stride * 4 / 1.0]]).view(1, 1, 4)
-            variances = [0.1, 0.2]
-            box = batch_decode(loc, priors, variances)
-            box = box[:, 0] * 1.0
-            # cv2.rectangle(imgshow,(int(x1),int(y1)),(int(x2),int(y2)),(0,0,255),1)
-            bboxlist.append(torch.cat([box, score.unsqueeze(1)], 1).cpu().numpy())
-    bboxlist = np.array(bboxlist)
     if 0 == len(bboxlist):
         bboxlist = np.zeros((1, BB, 5))
 
@@ -9,13 +9,13 @@ class L2Norm(nn.Module):
         self.n_channels = n_channels
         self.scale = scale
         self.eps = 1e-10
-        self.weight = nn.Parameter(torch.Tensor(self.n_channels))
-        self.weight.data *= 0.0
-        self.weight.data += self.scale
+        # torch.full rather than scaling torch.Tensor(n) by 0, uninitialized memory may hold nan
+        self.weight = nn.Parameter(torch.full((self.n_channels,), float(self.scale)))
 
     def forward(self, x):
-        norm = x.pow(2).sum(dim=1, keepdim=True).sqrt() + self.eps
-        x = x / norm * self.weight.view(1, -1, 1, 1)
+        # The norm is computed in float32, squared activations overflow float16
+        norm = x.float().pow(2).sum(dim=1, keepdim=True).sqrt() + self.eps
+        x = (x.float() / norm * self.weight.float().view(1, -1, 1, 1)).to(x.dtype)
         return x
 
 
@@ -0,0 +1,48 @@
+import collections
+import numpy as np
+
+
+def smooth_boxes(boxes, T):
+    """Smooth a sequence of face boxes with a temporal mean over a window of ``T`` boxes.
+
+    Box ``i`` becomes the mean of boxes ``i`` to ``i + T - 1``; the last boxes all use the final
+    window. Uses a cumulative sum, so the cost is linear in the number of boxes whatever ``T`` is.
+
+    Arguments:
+        boxes {numpy.array} -- boxes of shape [N, 4], one per frame
+        T {int} -- window length
+
+    Returns the smoothed boxes with the dtype of ``boxes``.
+    """
+    boxes = np.asarray(boxes)
+    if len(boxes) == 0:
+        return boxes
+    T = min(T, len(boxes))
+    csum = np.zeros((len(boxes) + 1,) + boxes.shape[1:], dtype=np.float64)
+    np.cumsum(boxes, axis=0, out=csum[1:])
+    starts = np.minimum(np.arange(len(boxes)), len(boxes) - T)
+    return ((csum[starts + T] - csum[starts]) / T).astype(boxes.dtype)
+
+
+class OnlineBoxSmoother(object):
+    """Causal counterpart of ``smooth_boxes`` for streaming.
+
+    Each pushed box is replaced by the mean of the last ``T`` pushed boxes, so boxes can be
+    smoothed as frames arrive without knowing the rest of the video.
+    """
+
+    def __init__(self, T):
+        self.T = T
+        self.reset()
+
+    def reset(self):
+        self.window = collections.deque()
+        self.total = 0.
+
+    def push(self, box):
+        box = np.asarray(box)
+        self.window.append(box.astype(np.float64))
+        self.total = self.total + self.window[-1]
+        if len(self.window) > self.T:
+            self.total = self.total - self.window.popleft()
+        return (self.total / len(self.window)).astype(box.dtype)
@@ -129,6 +129,45 @@ def crop(image, center, scale, resolution=256.0):
     return newImg
 
 
+def transform_inverse_batch(points, centers, scales, resolution):
+    """Vectorized ``transform(point, center, scale, resolution, True)``.
+
+    The inverse of the crop transform is applied analytically instead of inverting a matrix
+    per point.
+
+    Arguments:
+        points {torch.tensor} -- points in heatmap coordinates, of shape [B, N, 2]
+        centers {torch.tensor or numpy.array} -- the center of each bounding box, of shape [B, 2]
+        scales {torch.tensor or numpy.array} -- the scale of each face, of shape [B]
+        resolution {float} -- the heatmap resolution
+    """
+    centers = torch.as_tensor(centers, dtype=torch.float32, device=points.device).view(-1, 1, 2)
+    h = 200.0 * torch.as_tensor(scales, dtype=torch.float32, device=points.device).view(-1, 1, 1)
+    return (points * (h / resolution) + centers - h / 2).int()
+
+
+def _preds_from_heatmaps(hm):
+    # Argmax of every heatmap (1-based, x then y), moved a quarter pixel towards the higher
+    # neighbour and shifted by -.5, for all heatmaps of the batch at once
+    B, N, H, W = hm.size()
+    hm_flat = hm.reshape(B, N, H * W)
+    _, idx = torch.max(hm_flat, 2)
+    pX, pY = idx % W, idx // W
+    preds = torch.stack([pX + 1, pY + 1], 2).float()
+
+    # Neighbours are read at clamped positions, border points get no refinement
+    inside = (pX > 0) & (pX < W - 1) & (pY > 0) & (pY < H - 1)
+    cX, cY = pX.clamp(1, W - 2), pY.clamp(1, H - 2)
+
+    def at(y, x):
+        return hm_flat.gather(2, (y * W + x).unsqueeze(2)).squeeze(2)
+
+    diff = torch.stack([at(cY, cX + 1) - at(cY, cX - 1), at(cY + 1, cX) - at(cY - 1, cX)], 2)
+    preds.add_(diff.sign_().mul_(.25) * inside.unsqueeze(2))
+    preds.add_(-.5)
+    return preds
+
+
 def get_preds_fromhm(hm, center=None, scale=None):
     """Obtain (x,y) coordinates given a set of N heatmaps. If the center
     and the scale is provided the function will return the points also in
@@ -141,31 +180,13 @@ def get_preds_fromhm(hm, center=None, scale=None):
         center {torch.tensor} -- the center of the bounding box (default: {None})
         scale {float} -- face scale (default: {None})
     """
-    max, idx = torch.max(
-        hm.view(hm.size(0), hm.size(1), hm.size(2) * hm.size(3)), 2)
-    idx += 1
-    preds = idx.view(idx.size(0), idx.size(1), 1).repeat(1, 1, 2).float()
-    preds[..., 0].apply_(lambda x: (x - 1) % hm.size(3) + 1)
-    preds[..., 1].add_(-1).div_(hm.size(2)).floor_().add_(1)
-
-    for i in range(preds.size(0)):
-        for j in range(preds.size(1)):
-            hm_ = hm[i, j, :]
-            pX, pY = int(preds[i, j, 0]) - 1, int(preds[i, j, 1]) - 1
-            if pX > 0 and pX < 63 and pY > 0 and pY < 63:
-                diff = torch.FloatTensor(
-                    [hm_[pY, pX + 1] - hm_[pY, pX - 1],
-                     hm_[pY + 1, pX] - hm_[pY - 1, pX]])
-                preds[i, j].add_(diff.sign_().mul_(.25))
+    preds = _preds_from_heatmaps(hm)
 
-    preds.add_(-.5)
-
-    preds_orig = torch.zeros(preds.size())
+    preds_orig = torch.zeros(preds.size(), device=preds.device)
     if center is not None and scale is not None:
-        for i in range(hm.size(0)):
-            for j in range(hm.size(1)):
-                preds_orig[i, j] = transform(
-                    preds[i, j], center, scale, hm.size(2), True)
+        centers = torch.as_tensor(center, dtype=torch.float32).view(1, 2).expand(hm.size(0), 2)
+        scales = torch.full((hm.size(0),), float(scale))
+        preds_orig[:] = transform_inverse_batch(preds, centers, scales, hm.size(2))
 
     return preds, preds_orig
 
@@ -181,31 +202,11 @@ def get_preds_fromhm_batch(hm, centers=None, scales=None):
         centers {torch.tensor} -- the centers of the bounding box (default: {None})
         scales {float} -- face scales (default: {None})
     """
-    max, idx = torch.max(
-        hm.view(hm.size(0), hm.size(1), hm.size(2) * hm.size(3)), 2)
-    idx += 1
-    preds = idx.view(idx.size(0), idx.size(1), 1).repeat(1, 1, 2).float()
-    preds[..., 0].apply_(lambda x: (x - 1) % hm.size(3) + 1)
-    preds[..., 1].add_(-1).div_(hm.size(2)).floor_().add_(1)
-
-    for i in range(preds.size(0)):
-        for j in range(preds.size(1)):
-            hm_ = hm[i, j, :]
-            pX, pY = int(preds[i, j, 0]) - 1, int(preds[i, j, 1]) - 1
-            if pX > 0 and pX < 63 and pY > 0 and pY < 63:
-                diff = torch.FloatTensor(
-                    [hm_[pY, pX + 1] - hm_[pY, pX - 1],
-                     hm_[pY + 1, pX] - hm_[pY - 1, pX]])
-                preds[i, j].add_(diff.sign_().mul_(.25))
-
-    preds.add_(-.5)
+    preds = _preds_from_heatmaps(hm)
 
-    preds_orig = torch.zeros(preds.size())
+    preds_orig = torch.zeros(preds.size(), device=preds.device)
     if centers is not None and scales is not None:
-        for i in range(hm.size(0)):
-            for j in range(hm.size(1)):
-                preds_orig[i, j] = transform(
-                    preds[i, j], centers[i], scales[i], hm.size(2), True)
+        preds_orig[:] = transform_inverse_batch(preds, centers, scales, hm.size(2))
 
     return preds, preds_orig
 
@@ -1,15 +1,19 @@
 import argparse
-import math
+import hashlib
 import os
 import cv2
 import numpy as np
 import pandas as pd
 import torch
 from tqdm import tqdm
+import threading
+import collections
+import queue
 import openvino as ov
 import audio
-from models import Wav2Lip
-from batch_face import RetinaFace
+from models import Wav2Lip, fuse_for_inference
+import face_detection
+from face_detection import OnlineBoxSmoother
 # from retinaface import RetinaFace as retina_face
 from time import time, sleep
 import pyaudio
@@ -32,6 +36,11 @@ parser.add_argument('--fps', type=float, help='Can be specified only if input is
 parser.add_argument('--pads', nargs='+', type=int, default=[0, 10, 0, 0], 
                     help='Padding (top, bottom, left, right). Please adjust to include chin at least')
 parser.add_argument('--wav2lip_batch_size', type=int, help='Batch size for Wav2Lip model(s)', default=8)
+parser.add_argument('--latency_budget', type=float, default=0,
+                    help='Target Wav2Lip model time per batch in ms. If set, the batch size adapts to meet it, '
+                    'starting from --wav2lip_batch_size. 0 keeps the batch size fixed')
+parser.add_argument('--max_wav2lip_batch_size', type=int, default=64,
+                    help='Upper bound for the batch size chosen with --latency_budget')
 parser.add_argument('--resize_factor', default=1, type=int,
                     help='Reduce the resolution by this factor. Sometimes, best results are obtained at 480p or 720p')
 parser.add_argument('--out_height', default=480, type=int,
@@ -45,7 +54,390 @@ parser.add_argument('--box', nargs='+', type=int, default=[-1, -1, -1, -1],
 parser.add_argument('--rotate', default=False, action='store_true',
                     help='Sometimes videos taken from a phone can be flipped 90deg. If true, will flip video right by 90deg.'
                     'Use if you get a flipped result, despite feeding a normal looking video')
+parser.add_argument('--frame_lookahead', default=32, type=int,
+                    help='Number of decoded avatar video frames buffered ahead of inference')
+parser.add_argument('--frame_cache_size', default=100, type=int,
+                    help='Max number of avatar video frames whose prepared face and RGB frame are kept in memory. '
+                    'Must be at least the number of video frames per audio window')
+parser.add_argument('--pingpong', default=False, action='store_true',
+                    help='Play the avatar video backwards after it ends instead of jumping back to the first frame')
+parser.add_argument('--detect_every', default=1, type=int,
+                    help='Run face detection only on every Nth video frame (and on frames that moved, see --motion_threshold), '
+                    'boxes of the frames in between are interpolated. 1 detects on every frame')
+parser.add_argument('--motion_threshold', default=8., type=float,
+                    help='Mean absolute difference of 32x32 grayscale thumbnails (0-255) to the last keyframe '
+                    'above which a frame is detected regardless of --detect_every')
 parser.add_argument('--nosmooth', default=False, action='store_true', help='Prevent smoothing face detections over a short temporal window')
+parser.add_argument('--face_detector', default='retinaface', choices=list(face_detection.DETECTORS),
+                    help='Face detector, see face_detection.load_detector')
+parser.add_argument('--detect_short_side', default=None, type=int,
+                    help='Run face detection on frames resized to this shorter side, boxes are mapped back to full resolution')
+parser.add_argument('--face_det_cache_dir', default='temp/face_det_cache', type=str,
+                    help='Folder where the face boxes of every avatar are stored, so later runs on the same avatar '
+                    'skip detection. Empty string disables the cache')
+parser.add_argument('--ov_infer_requests', default=2, type=int,
+                    help='Number of OpenVINO infer requests kept in flight on CPU. 0 lets OpenVINO pick the optimal number')
+
+def preprocess_frame(frame, args):
+    if args.resize_factor > 1:
+        frame = cv2.resize(frame, (frame.shape[1]//args.resize_factor, frame.shape[0]//args.resize_factor))
+    aspect_ratio = frame.shape[1] / frame.shape[0]
+    frame = cv2.resize(frame, (int(args.out_height * aspect_ratio), args.out_height))
+
+    if args.rotate:
+        frame = cv2.rotate(frame, cv2.ROTATE_90_CLOCKWISE)
+    y1, y2, x1, x2 = args.crop
+    if x2 == -1: x2 = frame.shape[1]
+    if y2 == -1: y2 = frame.shape[0]
+    return frame[y1:y2, x1:x2]
+
+class StaticFrameSource:
+    # Frame source of a still image, every output frame is frame 0
+    def __init__(self, frame):
+        self.frame = frame
+        self.num_frames = 1
+
+    def take(self, n):
+        return [(0, self.frame)] * n
+
+    def close(self):
+        pass
+
+class VideoFrameSource:
+    """Decodes avatar video frames on demand on a background thread.
+
+    At most ``lookahead`` decoded frames wait in the queue, so memory does not grow with the
+    video length and the first frames are available right away. When the video ends it starts
+    again from the first frame or, with ``pingpong``, plays backwards first; the backwards pass
+    is decoded in blocks of ``lookahead`` frames.
+    """
+    def __init__(self, path, args, lookahead=32, pingpong=False):
+        self.path = path
+        self.args = args
+        self.lookahead = lookahead
+        self.pingpong = pingpong
+        video_stream = cv2.VideoCapture(path)
+        self.fps = video_stream.get(cv2.CAP_PROP_FPS)
+        self.num_frames = int(video_stream.get(cv2.CAP_PROP_FRAME_COUNT)) # As reported by the container, may be off
+        video_stream.release()
+        self.queue = queue.Queue(maxsize=lookahead)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._decode, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _decode(self):
+        video_stream = cv2.VideoCapture(self.path)
+        try:
+            while not self.stopped.is_set():
+                video_stream.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                count = 0
+                while not self.stopped.is_set():
+                    still_reading, frame = video_stream.read()
+                    if not still_reading:
+                        break
+                    self._put((count, preprocess_frame(frame, self.args)))
+                    count += 1
+                if count == 0:
+                    self._put(ValueError('Could not read any frame from {}'.format(self.path)))
+                    return
+                if self.pingpong:
+                    # Frames count - 2 down to 1, so the turning points are not shown twice
+                    end = count - 1
+                    while end > 1 and not self.stopped.is_set():
+                        start = max(1, end - self.lookahead)
+                        video_stream.set(cv2.CAP_PROP_POS_FRAMES, start)
+                        block = []
+                        for idx in range(start, end):
+                            still_reading, frame = video_stream.read()
+                            if not still_reading:
+                                break
+                            block.append((idx, preprocess_frame(frame, self.args)))
+                        for item in reversed(block):
+                            self._put(item)
+                        end = start
+        except Exception as e:
+            self._put(e)
+        finally:
+            video_stream.release()
+
+    def take(self, n):
+        # Next n frames as (frame index in the video, frame)
+        frames = []
+        for _ in range(n):
+            item = self.queue.get()
+            if isinstance(item, Exception):
+                raise item
+            frames.append(item)
+        return frames
+
+    def close(self):
+        self.stopped.set()
+
+class AudioCapture:
+    """Records the microphone on pyaudio's callback thread into a ring buffer.
+
+    Capture keeps running while the previous window is being rendered, so the next
+    audio window is usually ready as soon as inference asks for it. When rendering falls
+    more than a window behind, ``read`` skips ahead to the newest window.
+    """
+    def __init__(self, rate, channels, format, chunk, capacity_seconds=5.0):
+        self.capacity = int(rate * capacity_seconds)
+        self.buffer = np.zeros(self.capacity, dtype=np.int16)
+        self.write_pos = 0 # Total number of samples written since start
+        self.read_pos = 0 # Total number of samples consumed since start
+        self.cond = threading.Condition()
+        self.pa = pyaudio.PyAudio()
+        self.stream = self.pa.open(format=format,
+                                   channels=channels,
+                                   rate=rate,
+                                   input=True,
+                                   frames_per_buffer=chunk,
+                                   stream_callback=self._callback)
+        self.stream.start_stream()
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        samples = np.frombuffer(in_data, dtype=np.int16)[-self.capacity:]
+        with self.cond:
+            start = self.write_pos % self.capacity
+            end = min(start + len(samples), self.capacity)
+            self.buffer[start:end] = samples[:end - start]
+            self.buffer[:len(samples) - (end - start)] = samples[end - start:]
+            self.write_pos += len(samples)
+            if self.write_pos - self.read_pos > self.capacity:
+                # Renderer fell behind, drop the oldest audio instead of growing the buffer.
+                print("Warning: audio buffer overflow, dropping oldest samples.")
+                self.read_pos = self.write_pos - self.capacity
+            self.cond.notify_all()
+        return (None, pyaudio.paContinue)
+
+    def read(self, num_samples):
+        if num_samples > self.capacity:
+            raise ValueError('Requested {} samples but the capture buffer holds only {}'.format(num_samples, self.capacity))
+        with self.cond:
+            self.cond.wait_for(lambda: self.write_pos - self.read_pos >= num_samples)
+            if self.write_pos - self.read_pos > 2 * num_samples:
+                # More than a window behind (rendering slower than real time): jump to the newest window
+                # so latency stays bounded instead of growing until the ring buffer overflows.
+                skipped = self.write_pos - self.read_pos - num_samples
+                print("Warning: rendering is behind, skipping {} audio samples.".format(skipped))
+                self.read_pos = self.write_pos - num_samples
+            start = self.read_pos % self.capacity
+            idx = np.arange(start, start + num_samples) % self.capacity
+            data = self.buffer[idx]
+            self.read_pos += num_samples
+        return data
+
+    def close(self):
+        self.stream.stop_stream()
+        self.stream.close()
+        self.pa.terminate()
+
+# Arguments that change the face boxes of an avatar, part of the DetectionCache key
+DETECTION_CACHE_ARGS = ['face_detector', 'static', 'resize_factor', 'out_height', 'rotate', 'crop', 'pads', 'nosmooth',
+                        'detect_every', 'motion_threshold', 'detect_short_side']
+# Bump when the stored boxes change meaning, so caches written by older code are ignored
+DETECTION_CACHE_VERSION = 2
+
+class DetectionCache:
+    """Face boxes of an avatar stored on disk, so repeat runs on the same avatar skip detection.
+
+    Boxes (y1, y2, x1, x2, after padding and smoothing) are kept per frame index in
+    <cache_dir>/<key>.npy, where the key hashes the avatar file content and ``settings``.
+    Unknown frames are stored as -1 rows.
+    """
+    def __init__(self, cache_dir, avatar_path, settings):
+        digest = hashlib.sha1()
+        with open(avatar_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        digest.update(repr((DETECTION_CACHE_VERSION, settings)).encode())
+        self.path = os.path.join(cache_dir, digest.hexdigest() + '.npy')
+        try:
+            self.boxes = np.load(self.path)
+        except (IOError, ValueError):
+            self.boxes = np.full((0, 4), -1, dtype=np.int64)
+
+    def __contains__(self, idx):
+        return idx < len(self.boxes) and self.boxes[idx, 0] >= 0
+
+    def __getitem__(self, idx):
+        return tuple(map(int, self.boxes[idx]))
+
+    def put(self, idx, coords):
+        if idx >= len(self.boxes):
+            grown = np.full((max(idx + 1, 2 * len(self.boxes)), 4), -1, dtype=np.int64)
+            grown[:len(self.boxes)] = self.boxes
+            self.boxes = grown
+        self.boxes[idx] = coords
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Written under a unique name and renamed, so concurrent jobs never read a partial file
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, self.boxes)
+        os.replace(tmp_path, self.path)
+
+class FaceTensorCache:
+    """Ready-to-feed face tensors and crop coordinates keyed by frame index.
+
+    Each slot holds the masked and the reference face stacked as one (6, img_size, img_size)
+    float32 tensor, so a batch is a single gather from the preallocated array. When the cache
+    is full the oldest entry is overwritten.
+    """
+    def __init__(self, img_size, capacity):
+        self.img_size = img_size
+        self.capacity = capacity
+        self.tensors = np.empty((capacity, 6, img_size, img_size), dtype=np.float32)
+        self.coords = np.empty((capacity, 4), dtype=np.int64)
+        self.slots = {} # frame index -> slot
+        self.keys = [None] * capacity # slot -> frame index
+        self.next_slot = 0
+
+    def __contains__(self, key):
+        return key in self.slots
+
+    def put(self, key, face, coords):
+        slot = self.next_slot
+        self.next_slot = (self.next_slot + 1) % self.capacity
+        if self.keys[slot] is not None:
+            del self.slots[self.keys[slot]]
+        self.keys[slot] = key
+        self.slots[key] = slot
+
+        face = cv2.resize(face, (self.img_size, self.img_size))
+        tensor = self.tensors[slot]
+        np.divide(face.transpose(2, 0, 1), np.float32(255.), out=tensor[3:])
+        tensor[:3] = tensor[3:]
+        tensor[:3, self.img_size//2:] = 0
+        self.coords[slot] = coords
+
+    def gather(self, keys):
+        slots = [self.slots[k] for k in keys]
+        return self.tensors[slots], self.coords[slots]
+
+class FrameCompositor:
+    """Pastes predicted faces into RGB copies of the avatar frames.
+
+    Avatar frames are converted to RGB once per frame index and composited into one reusable
+    output buffer, so per output frame only the face ROI is resized, converted and pasted. The
+    background is copied again only when the avatar frame changes; for a static image it never is.
+    The returned frame is overwritten by the next call to compose().
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.rgb_frames = {} # frame index -> RGB frame, oldest entries dropped beyond capacity
+        self.out = None
+        self.out_key = None # frame index currently in the output buffer
+        self.out_coords = None # face ROI pasted into the output buffer last time
+
+    def get_rgb_frame(self, key, frame):
+        rgb = self.rgb_frames.get(key)
+        if rgb is None:
+            rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            self.rgb_frames[key] = rgb
+            if len(self.rgb_frames) > self.capacity:
+                del self.rgb_frames[next(iter(self.rgb_frames))]
+        return rgb
+
+    def compose(self, key, frame, pred, coords):
+        # pred is the BGR face predicted by the model in [0, 255], coords are (y1, y2, x1, x2) in the frame
+        rgb = self.get_rgb_frame(key, frame)
+        if self.out is None or self.out.shape != rgb.shape:
+            self.out = rgb.copy()
+        elif key != self.out_key:
+            np.copyto(self.out, rgb)
+        elif self.out_coords is not None and tuple(self.out_coords) != tuple(coords):
+            # Same background, restore the previous ROI in case the new one does not cover it
+            y1, y2, x1, x2 = self.out_coords
+            self.out[y1:y2, x1:x2] = rgb[y1:y2, x1:x2]
+        self.out_key = key
+        self.out_coords = coords
+
+        y1, y2, x1, x2 = coords
+        # Channel swap on the small prediction instead of the full frame
+        p = pred[:, :, ::-1].astype(np.uint8)
+        self.out[y1:y2, x1:x2] = cv2.resize(p, (x2 - x1, y2 - y1))
+        return self.out
+
+class BatchSizeScheduler:
+    """Adapts the Wav2Lip batch size to a per-batch latency budget.
+
+    Model time is modelled as overhead + per_frame * batch_size, fitted by least squares on the
+    most recent measurements, and the largest batch size predicted to fit the budget is picked.
+    Old measurements fall out of the history, so the choice follows changes in machine load.
+    With latency_budget=0 the batch size stays fixed.
+    """
+    def __init__(self, batch_size, latency_budget=0, max_batch_size=64, history=16):
+        self.batch_size = batch_size
+        self.latency_budget = latency_budget # seconds
+        self.max_batch_size = max_batch_size
+        self.measurements = collections.deque(maxlen=history) # (batch size, seconds)
+
+    def update(self, batch_size, seconds):
+        if self.latency_budget <= 0:
+            return
+        self.measurements.append((batch_size, seconds))
+        sizes, times = np.array(self.measurements, dtype=np.float64).T
+        per_frame, overhead = 0., 0.
+        if len(np.unique(sizes)) > 1:
+            per_frame, overhead = np.polyfit(sizes, times, 1)
+        if per_frame <= 0 or overhead < 0:
+            # Not enough spread in the measurements for a fit, assume time proportional to batch size
+            per_frame, overhead = np.mean(times / sizes), 0.
+        new_batch_size = int((self.latency_budget - overhead) / per_frame)
+        new_batch_size = min(max(new_batch_size, 1), self.max_batch_size)
+        if new_batch_size != self.batch_size:
+            print('Batch size {} -> {} (model time {:.1f} ms + {:.1f} ms/frame)'.format(
+                self.batch_size, new_batch_size, overhead * 1000, per_frame * 1000))
+            self.batch_size = new_batch_size
+
+class AsyncInferPipeline:
+    """Runs OpenVINO inference asynchronously on a pool of infer requests.
+
+    submit() returns as soon as a request is free, so the caller can prepare the next batch and
+    composite finished ones while inference runs. Results are handed back in submission order.
+    """
+    def __init__(self, compiled_model, jobs=0):
+        self.compiled_model = compiled_model
+        self.queue = ov.AsyncInferQueue(compiled_model, jobs)
+        self.queue.set_callback(self._callback)
+        self.cond = threading.Condition()
+        self.results = {} # submission number -> (output, userdata, model time in seconds)
+        self.num_submitted = 0
+        self.num_returned = 0
+
+    def _callback(self, request, userdata):
+        seq, data = userdata
+        # The output tensor belongs to the infer request and is reused by its next job
+        output = request.get_output_tensor(0).data.copy()
+        with self.cond:
+            self.results[seq] = (output, data, request.latency / 1000.)
+            self.cond.notify_all()
+
+    def submit(self, inputs, userdata):
+        self.queue.start_async(inputs, (self.num_submitted, userdata))
+        self.num_submitted += 1
+
+    def completed(self, wait=False):
+        # Yields (output, userdata, model time) of finished jobs in submission order. With wait=True blocks until all are done.
+        while self.num_returned < self.num_submitted:
+            with self.cond:
+                if wait:
+                    self.cond.wait_for(lambda: self.num_returned in self.results)
+                elif self.num_returned not in self.results:
+                    return
+                result = self.results.pop(self.num_returned)
+            self.num_returned += 1
+            yield result
 
 class Wav2LipInference:
     def __init__(self, args) -> None:
@@ -57,30 +449,43 @@ class Wav2LipInference:
         self.RATE = 16000  # sample rate (samples per second)
         self.RECORD_SECONDS = 0.5  # Duration of audio recording per capture
         self.mel_step_size = 16 # Step size for mel spectrogram processing
+        self.mel_stream = audio.StreamingMelSpectrogram() # Carries filter/STFT state across audio windows
+        self.mel_chunker = audio.MelChunker(self.args.fps, self.mel_step_size)
         self.model = self.load_model()
+        # Split face encoder/decoder (OpenVINO only) used for static avatars, see model_convert.export_split_model
+        self.face_encoder, self.face_decoder = self.load_openvino_split_model() if self.device == 'cpu' else (None, None)
+        self.face_feats = None # Face encoder feature maps of the static avatar, computed on the first batch
         self.detector = self.load_batch_face_model()
+        self.face_batch_sizer = face_detection.DetectionBatchSizer(self.detector, self.device)
         self.face_detect_cache_result = None
+        self.detection_cache = None # DetectionCache of the current avatar, set up in main()
+        self.box_smoother = OnlineBoxSmoother(T=5)
+        self.last_smoothed_idx = None # Frame index of the last box pushed to self.box_smoother
+        self.face_cache = None # FaceTensorCache of the current avatar, set up in main()
+        self.compositor = None # FrameCompositor of the current avatar, set up in main()
+        self.infer_pipeline = None # AsyncInferPipeline for the OpenVINO path, created on the first batch
+        self.batch_scheduler = BatchSizeScheduler(args.wav2lip_batch_size, args.latency_budget / 1000.,
+                                                  args.max_wav2lip_batch_size)
 
 
-    def get_smoothened_boxes(self, boxes, T):
-        for i in range(len(boxes)):
-            if i + T > len(boxes):
-                window = boxes[len(boxes) - T:]
-            else:
-                window = boxes[i : i + T]
-            boxes[i] = np.mean(window, axis=0)
-        return boxes
-
-    def face_detect(self, images):
+    def face_detect(self, idxs, images):
+        # idxs: frame index of each image in the avatar video, used to keep the box smoothing causal.
+        # Returns one (frame index, face, (y1, y2, x1, x2)) per image. A frame without a detected face reuses
+        # the box of the previous frame (the first detected box for leading frames).
         results = []
         pady1, pady2, padx1, padx2 = self.args.pads
         s = time()
-        for image, rect in zip(images, self.face_rect(images)):
+        rects = list(self.face_rect(idxs, images))
+        detected = [rect for rect in rects if rect is not None]
+        if len(detected) == 0:
+            cv2.imwrite('temp/faulty_frame.jpg', images[0]) # check this frame where the face was not detected.
+            raise ValueError('Face not detected! Ensure the video contains a face in all the frames.')
+        prev_rect = detected[0]
+        for idx, image, rect in zip(idxs, images, rects):
             if rect is None:
-                print("Face was not detected...")
-                continue
-                cv2.imwrite('temp/faulty_frame.jpg', image) # check this frame where the face was not detected.
-                raise ValueError('Face not detected! Ensure the video contains a face in all the frames.')
+                print("Face was not detected in frame {}, reusing the box of a neighbouring frame".format(idx))
+                rect = prev_rect
+            prev_rect = rect
             y1 = max(0, rect[1] - pady1)
             y2 = min(image.shape[0], rect[3] + pady2)
             x1 = max(0, rect[0] - padx1)
@@ -89,51 +494,68 @@ class Wav2LipInference:
 
         print('face detect time:', time() - s)
         boxes = np.array(results)
-        if not self.args.nosmooth: boxes = self.get_smoothened_boxes(boxes, T=5)
-        results = [[image[y1: y2, x1:x2], (y1, y2, x1, x2)] for image, (x1, y1, x2, y2) in zip(images, boxes)]
+        # Causal smoothing carried across calls, frames are detected window by window while streaming
+        if not self.args.nosmooth: boxes = np.array([self.smooth_box(idx, box) for idx, box in zip(idxs, boxes)])
+        return [(idx, image[y1: y2, x1:x2], (y1, y2, x1, x2)) for idx, image, (x1, y1, x2, y2) in zip(idxs, images, boxes)]
+
+    def smooth_box(self, idx, box):
+        # The smoothing window only spans consecutive frames. Loop restarts, pingpong turns and frames
+        # detected again after FaceTensorCache eviction start a new window, so unrelated parts of the
+        # video are not averaged together.
+        if self.last_smoothed_idx is None or idx != self.last_smoothed_idx + 1:
+            self.box_smoother.reset()
+        self.last_smoothed_idx = idx
+        return self.box_smoother.push(box)
+
+    def cached_face_detect(self, idxs, images):
+        # face_detect() backed by self.detection_cache, only frames without a stored box are detected
+        if self.detection_cache is None:
+            return self.face_detect(idxs, images)
+        todo = [i for i, idx in enumerate(idxs) if idx not in self.detection_cache]
+        if len(todo) > 0:
+            # Stored by the frame index face_detect reports, never by position, and only saved once
+            # every requested frame has its box
+            for idx, _, coords in self.face_detect([idxs[i] for i in todo], [images[i] for i in todo]):
+                self.detection_cache.put(idx, coords)
+            unresolved = [idxs[i] for i in todo if idxs[i] not in self.detection_cache]
+            if len(unresolved) > 0:
+                raise ValueError('No face box for frames {}'.format(unresolved))
+            self.detection_cache.save()
+        results = []
+        for idx, image in zip(idxs, images):
+            y1, y2, x1, x2 = self.detection_cache[idx]
+            results.append((idx, image[y1: y2, x1:x2], (y1, y2, x1, x2)))
         return results
 
     def datagen(self, frames, mels):
-
-        img_batch, mel_batch, frame_batch, coords_batch = [], [], [], []
-        if self.args.box[0] == -1:
-            if not self.args.static:
-                face_det_results = self.face_detect(frames) # BGR2RGB for CNN face detection
+        # frames: one (frame index, frame) per mel chunk, see VideoFrameSource.take().
+        # Yields (img_batch (B, 6, H, W), mel_batch (B, 1, 80, 16), frame indices, coords) ready for predict().
+        # Face tensors come from self.face_cache, detection only runs for frames not prepared yet.
+        idxs = [idx for idx, _ in frames]
+        frames = dict(frames)
+        missing = sorted(idx for idx in set(idxs) if idx not in self.face_cache)
+        if len(missing) > 0:
+            if self.args.box[0] == -1:
+                if not self.args.static:
+                    face_det_results = self.cached_face_detect(missing, [frames[idx] for idx in missing]) # BGR2RGB for CNN face detection
+                else:
+                    face_det_results = self.face_detect_cache_result # use cached result face_detect([0], [frames[0]])
             else:
-                face_det_results = self.face_detect_cache_result # use cached result face_detect([frames[0]])
-        else:
-            print('Using the specified bounding box instead of face detection...')
-            y1, y2, x1, x2 = self.args.box
-            face_det_results = [[f[y1: y2, x1:x2], (y1, y2, x1, x2)] for f in frames]
-        for i, m in enumerate(mels):        
-            idx = 0 if self.args.static else i%len(frames)
-            frame_to_save = frames[idx].copy()
-            face, coords = face_det_results[idx].copy()
-            face = cv2.resize(face, (self.args.img_size, self.args.img_size))
-            img_batch.append(face)
-            mel_batch.append(m)
-            frame_batch.append(frame_to_save)
-            coords_batch.append(coords)
-
-            if len(img_batch) >= self.args.wav2lip_batch_size:
-                img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
-                img_masked = img_batch.copy()
-                img_masked[:, self.args.img_size//2:] = 0
-                img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
-                mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
-                yield img_batch, mel_batch, frame_batch, coords_batch
-                img_batch, mel_batch, frame_batch, coords_batch = [], [], [], []
-
-        # if there are any other batches
-        if len(img_batch) > 0:
-            
-            img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
-            img_masked = img_batch.copy()
-            img_masked[:, self.args.img_size//2:] = 0
-            img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
-            mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
-
-            yield img_batch, mel_batch, frame_batch, coords_batch
+                print('Using the specified bounding box instead of face detection...')
+                y1, y2, x1, x2 = self.args.box
+                face_det_results = [(idx, frames[idx][y1: y2, x1:x2], (y1, y2, x1, x2)) for idx in missing]
+            for idx, face, coords in face_det_results:
+                self.face_cache.put(idx, face, coords)
+
+        i = 0
+        while i < len(mels):
+            # Re-read on every batch, the scheduler adapts it to the measured model time
+            batch_size = self.batch_scheduler.batch_size
+            batch_idxs = idxs[i:i + batch_size]
+            img_batch, coords_batch = self.face_cache.gather(batch_idxs)
+            mel_batch = np.asarray(mels[i:i + batch_size], dtype=np.float32)[:, np.newaxis]
+            yield img_batch, mel_batch, batch_idxs, coords_batch
+            i += batch_size
 
     def load_model(self):
         if self.device == 'cpu':
@@ -151,6 +573,52 @@ class Wav2LipInference:
         compiled_model = core.compile_model(model=model, device_name=avail_devices[0])
         return compiled_model
 
+    def load_openvino_split_model(self):
+        encoder_path, decoder_path = "./wav2lip_openvino_face_encoder.xml", "./wav2lip_openvino_decoder.xml"
+        if not (os.path.isfile(encoder_path) and os.path.isfile(decoder_path)):
+            return None, None
+        print("Calling OpenVINO split face encoder/decoder for static avatars")
+        core = ov.Core()
+        device_name = core.available_devices[0]
+        encoder = core.compile_model(model=core.read_model(model=encoder_path), device_name=device_name)
+        decoder = core.compile_model(model=core.read_model(model=decoder_path), device_name=device_name)
+        return encoder, decoder
+
+    def get_openvino_inputs(self, mel_batch, img_batch):
+        # With a static avatar every face input is identical, so the face encoder runs once and only the
+        # audio encoder and face decoder run per batch.
+        if self.args.static and self.face_decoder is not None:
+            if self.face_feats is None:
+                outputs = self.face_encoder([img_batch[:1]])
+                self.face_feats = [outputs[out] for out in self.face_encoder.outputs]
+            return self.face_decoder, [mel_batch] + self.face_feats
+        return self.model, [mel_batch, img_batch]
+
+    def predict(self, mel_batch, img_batch):
+        # mel_batch: (B, 1, 80, 16), img_batch: (B, 6, 96, 96). Returns (B, 3, 96, 96) numpy predictions.
+        if self.device == 'cpu':
+            model, inputs = self.get_openvino_inputs(mel_batch, img_batch)
+            return model(inputs)['output']
+
+        mel_batch = torch.FloatTensor(mel_batch).to(self.device)
+        with torch.no_grad():
+            if self.args.static:
+                if self.face_feats is None:
+                    img_batch = torch.FloatTensor(img_batch[:1]).to(self.device)
+                    self.face_feats = self.model.encode_face(img_batch)
+                pred = self.model.decode(mel_batch, self.face_feats)
+            else:
+                img_batch = torch.FloatTensor(img_batch).to(self.device)
+                pred = self.model(mel_batch, img_batch)
+        return pred.cpu().numpy()
+
+    def predict_async(self, mel_batch, img_batch, userdata):
+        # OpenVINO only, results are collected with self.infer_pipeline.completed()
+        model, inputs = self.get_openvino_inputs(mel_batch, img_batch)
+        if self.infer_pipeline is None:
+            self.infer_pipeline = AsyncInferPipeline(model, self.args.ov_infer_requests)
+        self.infer_pipeline.submit(inputs, userdata)
+
     def load_wav2lip_model(self, checkpoint_path):
         model = Wav2Lip()
         print("Load checkpoint from: {}".format(checkpoint_path))
@@ -159,7 +627,7 @@ class Wav2LipInference:
         new_s = {k.replace('module.', ''): v for k, v in s.items()}
         model.load_state_dict(new_s)
         model = model.to(self.device)
-        return model.eval()
+        return fuse_for_inference(model)
     
     def load_model_weights(self, checkpoint_path):
         if self.device == 'cuda':
@@ -169,36 +637,68 @@ class Wav2LipInference:
         return checkpoint
 
     def load_batch_face_model(self):
-        if self.device == 'cpu':
-            return RetinaFace(gpu_id=-1, model_path="checkpoints/mobilenet.pth", network="mobilenet")
-        else:
-            return RetinaFace(gpu_id=0, model_path="checkpoints/mobilenet.pth", network="mobilenet")
-
-    def face_rect(self, images):
-        # Define the batch size for processing faces in chunks.
-        face_batch_size = 64 * 8
-        num_batches = math.ceil(len(images) / face_batch_size)
-        prev_rect = None
-        for i in range(num_batches):
-            # Get the current batch of images.
-            batch = images[i * face_batch_size: (i + 1) * face_batch_size]
-            # Detect faces in the current batch.
-            faces = self.detector(batch)
-            for face in faces:
-                if face:
-                    # Get the bounding box coordinates of the first detected face.
-                    box, _, _ = face[0]
-                    prev_rect = tuple(map(int, box))
+        return face_detection.load_detector(self.args.face_detector, device=self.device)
+
+    def detect_faces(self, images):
+        # Box of the first detected face per image, None where no face was found
+        images, scale = face_detection.resize_for_detection(images, self.args.detect_short_side)
+
+        def detect(batch):
+            boxes, counts = self.detector.detect_batch(np.asarray(batch))
+            # Bounding box of the best detected face, at full resolution.
+            return [tuple(int(v / scale) for v in box) if count > 0 else None
+                    for box, count in zip(boxes[:, 0, :4], counts)]
+
+        # Batches are sized from the frame size and free memory, see face_detection.DetectionBatchSizer
+        yield from self.face_batch_sizer.run(detect, images)
+
+    def select_keyframes(self, idxs, images):
+        # Every --detect_every'th frame of each run of consecutive frame indices, the first and last frame of
+        # every run, and frames that changed too much since the last keyframe. Runs break at loop restarts and
+        # pingpong turns, so no box is interpolated between unrelated parts of the video.
+        keyframes = []
+        key_thumb = None
+        run_start = 0
+        for i, (idx, image) in enumerate(zip(idxs, images)):
+            if i > 0 and idx != idxs[i - 1] + 1:
+                run_start = i
+            run_end = i == len(images) - 1 or idxs[i + 1] != idx + 1
+            thumb = cv2.resize(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+            if (i - run_start) % self.args.detect_every == 0 or run_end or np.abs(thumb - key_thumb).mean() > self.args.motion_threshold:
+                keyframes.append(i)
+                key_thumb = thumb
+        return keyframes
+
+    def face_rect(self, idxs, images):
+        # idxs: frame index of each image in the avatar video
+        if self.args.detect_every <= 1:
+            prev_rect = None
+            for rect in self.detect_faces(images):
+                if rect is not None:
+                    prev_rect = rect
                 yield prev_rect
+            return
+
+        # Tracking mode: detect on keyframes only and interpolate the boxes in between
+        keyframes = self.select_keyframes(idxs, images)
+        rects = list(self.detect_faces([images[i] for i in keyframes]))
+        detected = [(i, rect) for i, rect in zip(keyframes, rects) if rect is not None]
+        if len(detected) == 0:
+            yield from [None] * len(images)
+            return
+        key_idxs = np.array([i for i, _ in detected])
+        key_rects = np.array([rect for _, rect in detected], dtype=np.float64)
+        # np.interp holds the nearest keyframe box before the first and after the last detection
+        boxes = np.stack([np.interp(np.arange(len(images)), key_idxs, key_rects[:, c]) for c in range(4)], axis=1)
+        for box in np.rint(boxes).astype(int):
+            yield tuple(map(int, box))
 
     def record_audio(self, audio_stream):
         stime = time()
         print("Recording audio")
-        frames = []
-        for i in range(0, int(self.RATE / self.CHUNK * self.RECORD_SECONDS)):
-            frames.append(audio_stream.read(self.CHUNK, exception_on_overflow=False))
+        # audio_stream is an AudioCapture, this only waits for whatever part of the window is not recorded yet.
+        audio_data = audio_stream.read(int(self.RATE * self.RECORD_SECONDS))
         print("Recording time: ", time() - stime)
-        audio_data = np.frombuffer(b''.join(frames), dtype=np.int16)
         # Check if audio data has sufficient amplitude
         if np.max(np.abs(audio_data)) < 500:
             print("Warning: Recorded audio is too quiet.")
@@ -207,54 +707,48 @@ class Wav2LipInference:
 
     def get_mel_chunks(self, audio_data):
         stime = time()
-        mel = audio.melspectrogram(audio_data)
+        # Microphone samples are int16, the mel pipeline expects float audio in [-1, 1] like audio.load_wav
+        mel = self.mel_stream.push(audio_data.astype(np.float32) / 32768.)
         print(mel.shape)
         if np.isnan(mel.reshape(-1)).sum() > 0:
             raise ValueError('Mel contains nan! Using a TTS voice? Add a small epsilon noise to the wav file and try again')
-        mel_chunks = []
-        mel_idx_multiplier = 80./self.args.fps
-        i = 0
-        while 1:
-            start_idx = int(i * mel_idx_multiplier)
-            if start_idx + self.mel_step_size > len(mel[0]):
-                mel_chunks.append(mel[:, len(mel[0]) - self.mel_step_size:])
-                break
-            mel_chunks.append(mel[:, start_idx : start_idx + self.mel_step_size])
-            i += 1
+        mel_chunks = self.mel_chunker.push(mel)
         print("Length of mel chunks: {}".format(len(mel_chunks)))
         return mel_chunks
 
-def update_frames(full_frames, audio_stream, inference_obj):
+def update_frames(frame_source, audio_stream, inference_obj):
     stime = time()
     audio_data = inference_obj.record_audio(audio_stream)
     mel_chunks = inference_obj.get_mel_chunks(audio_data)
     print(f"Time to process audio input {time()-stime}")
 
-    full_frames = full_frames[:len(mel_chunks)]
-    wav2lip_batch_size = inference_obj.args.wav2lip_batch_size
-    gen = inference_obj.datagen(full_frames.copy(), mel_chunks.copy())
+    frames = frame_source.take(len(mel_chunks))
+    wav2lip_batch_size = inference_obj.batch_scheduler.batch_size
+    gen = inference_obj.datagen(frames, mel_chunks)
+    frames = dict(frames)
 
     s = time()
-    for i, (img_batch, mel_batch, frames, coords) in enumerate(tqdm(gen, total=int(np.ceil(float(len(mel_chunks)) / wav2lip_batch_size)))):
+    for i, (img_batch, mel_batch, idxs, coords) in enumerate(tqdm(gen, total=int(np.ceil(float(len(mel_chunks)) / wav2lip_batch_size)))):
         if inference_obj.device == 'cpu':
-            img_batch = np.transpose(img_batch, (0, 3, 1, 2))
-            mel_batch = np.transpose(mel_batch, (0, 3, 1, 2))
-            pred = inference_obj.model([mel_batch, img_batch])['output']
+            # Keep inference running while finished batches are composited
+            inference_obj.predict_async(mel_batch, img_batch, (idxs, coords))
+            yield from composite_frames(frames, inference_obj, inference_obj.infer_pipeline.completed())
         else:
-            img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(inference_obj.device)
-            mel_batch = torch.FloatTensor(np.transpose(mel_batch, (0, 3, 1, 2))).to(inference_obj.device)
-            with torch.no_grad():
-                pred = inference_obj.model(mel_batch, img_batch)
+            stime = time()
+            pred = inference_obj.predict(mel_batch, img_batch)
+            yield from composite_frames(frames, inference_obj, [(pred, (idxs, coords), time() - stime)])
 
+    if inference_obj.infer_pipeline is not None:
+        yield from composite_frames(frames, inference_obj, inference_obj.infer_pipeline.completed(wait=True))
+
+def composite_frames(frames, inference_obj, results):
+    # frames maps frame index -> frame
+    for pred, (idxs, coords), model_time in results:
+        inference_obj.batch_scheduler.update(len(idxs), model_time)
         pred = pred.transpose(0, 2, 3, 1) * 255.
-        for p, f, c in zip(pred, frames, coords):
-            y1, y2, x1, x2 = c
-            p = cv2.resize(p.astype(np.uint8), (x2 - x1, y2 - y1))
-            f[y1:y2, x1:x2] = p
-            # Convert frame to RGB before yielding
-            rgb_frame = cv2.cvtColor(f, cv2.COLOR_BGR2RGB)
+        for p, idx, c in zip(pred, idxs, coords):
             # Return the RGB frame for display in Streamlit
-            yield rgb_frame
+            yield inference_obj.compositor.compose(idx, frames[idx], p, c)
 
 def main(image_path, flag):
 
@@ -268,45 +762,38 @@ def main(image_path, flag):
     if not os.path.isfile(args.face):
         raise ValueError('--face argument must be a valid path to video/image file')
     elif args.face.split('.')[-1] in ['jpg', 'png', 'jpeg']:
-        full_frames = [cv2.imread(args.face)]
+        frame_source = StaticFrameSource(cv2.imread(args.face))
         fps = args.fps
-    else:
+    elif args.static:
+        # Only the first video frame is used, no need to keep decoding the video
         video_stream = cv2.VideoCapture(args.face)
         fps = video_stream.get(cv2.CAP_PROP_FPS)
-        print('Reading video frames')
-        full_frames = []
-        while 1:
-            still_reading, frame = video_stream.read()
-            if not still_reading:
-                video_stream.release()
-                break
-            if args.resize_factor > 1:
-                frame = cv2.resize(frame, (frame.shape[1]//args.resize_factor, frame.shape[0]//args.resize_factor))
-            aspect_ratio = frame.shape[1] / frame.shape[0]
-            frame = cv2.resize(frame, (int(args.out_height * aspect_ratio), args.out_height))
-
-            if args.rotate:
-                frame = cv2.rotate(frame, cv2.cv2.ROTATE_90_CLOCKWISE)
-            y1, y2, x1, x2 = args.crop
-            if x2 == -1: x2 = frame.shape[1]
-            if y2 == -1: y2 = frame.shape[0]
-            frame = frame[y1:y2, x1:x2]
-            full_frames.append(frame)
-
-    print ("Number of frames available for inference: "+str(len(full_frames)))
-
-    p = pyaudio.PyAudio()
-    stream = p.open(format=inference_obj.FORMAT,
-                    channels=inference_obj.CHANNELS,
-                    rate=inference_obj.RATE,
-                    input=True,
-                    frames_per_buffer=inference_obj.CHUNK)
-    
-    inference_obj.face_detect_cache_result = inference_obj.face_detect([full_frames[0]])
+        still_reading, frame = video_stream.read()
+        video_stream.release()
+        if not still_reading:
+            raise ValueError('Could not read any frame from {}'.format(args.face))
+        frame_source = StaticFrameSource(preprocess_frame(frame, args))
+    else:
+        # Frames are decoded lazily while inference runs instead of being read into memory up front
+        frame_source = VideoFrameSource(args.face, args, lookahead=args.frame_lookahead, pingpong=args.pingpong)
+        fps = frame_source.fps
+
+    print ("Number of frames available for inference: "+str(frame_source.num_frames))
+
+    if args.face_det_cache_dir and args.box[0] == -1:
+        settings = {name: getattr(args, name) for name in DETECTION_CACHE_ARGS}
+        inference_obj.detection_cache = DetectionCache(args.face_det_cache_dir, args.face, settings)
+    if args.static:
+        inference_obj.face_detect_cache_result = inference_obj.cached_face_detect([0], [frame_source.frame])
+    cache_size = args.frame_cache_size if frame_source.num_frames <= 0 else min(frame_source.num_frames, args.frame_cache_size)
+    # Every frame of one audio window has to fit, datagen gathers them after preparing the whole window
+    cache_size = max(cache_size, int(np.ceil(args.fps * inference_obj.RECORD_SECONDS)) + 1)
+    inference_obj.face_cache = FaceTensorCache(args.img_size, cache_size)
+    inference_obj.compositor = FrameCompositor(cache_size)
+    stream = AudioCapture(inference_obj.RATE, inference_obj.CHANNELS, inference_obj.FORMAT, inference_obj.CHUNK)
     while True:
         if not flag:
-            stream.stop_stream()
             stream.close()
-            p.terminate()
+            frame_source.close()
             return 
-        yield from update_frames(full_frames, stream, inference_obj)
\ No newline at end of file
+        yield from update_frames(frame_source, stream, inference_obj)
\ No newline at end of file
@@ -3,17 +3,35 @@ import os
 from openvino.runtime import Core, save_model
 from openvino import convert_model
 
-from models import Wav2Lip
+from models import Wav2Lip, fuse_for_inference
 import numpy as np
 
 device = "cpu"
 
+class Wav2LipFaceEncoder(torch.nn.Module):
+    # Face half of Wav2Lip for export, outputs the skip-connection feature maps
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, face_sequences):
+        return tuple(self.model.encode_face(face_sequences))
+
+class Wav2LipFaceDecoder(torch.nn.Module):
+    # Audio encoder + face decoder for export, takes the feature maps of a single face
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, audio_sequences, *feats):
+        return self.model.decode(audio_sequences, list(feats))
+
 def convert_pytorch_to_openvino(checkpoint_path, onnx_path):
     # Load your PyTorch model
     model = Wav2Lip()  # Ensure to initialize your model correctly
     checkpoint = torch.load(checkpoint_path, map_location=torch.device('cpu'))
     model.load_state_dict(checkpoint["state_dict"])
-    model.eval()  # Set to evaluation mode
+    fuse_for_inference(model)  # Eval mode, BatchNorm folded into the convolutions before export
 
     # Create dummy input for exporting
     batch_size = 128
@@ -52,6 +70,43 @@ def convert_pytorch_to_openvino(checkpoint_path, onnx_path):
     # save_model(model, 'openvino_model/wav2lip_model.xml')
     print("OpenVINO model saved")
 
+    export_split_model(model, mel_batch_tensor, img_batch_tensor, onnx_path)
+
+def export_split_model(model, mel_batch_tensor, img_batch_tensor, onnx_path):
+    # Static avatars only need the face encoder once, the realtime loop then runs just the decoder per batch
+    encoder_onnx_path = onnx_path.replace('.onnx', '_face_encoder.onnx')
+    decoder_onnx_path = onnx_path.replace('.onnx', '_decoder.onnx')
+
+    face_tensor = img_batch_tensor[:1]
+    with torch.no_grad():
+        feats = model.encode_face(face_tensor)
+    feat_names = ['feat_{}'.format(i) for i in range(len(feats))]
+
+    print("Exporting split face encoder/decoder to ONNX format...")
+    torch.onnx.export(Wav2LipFaceEncoder(model),
+                      (face_tensor,),
+                      encoder_onnx_path,
+                      export_params=True,
+                      opset_version=11,
+                      do_constant_folding=True,
+                      input_names=['face_sequences'],
+                      output_names=feat_names)
+    torch.onnx.export(Wav2LipFaceDecoder(model),
+                      (mel_batch_tensor, *feats),
+                      decoder_onnx_path,
+                      export_params=True,
+                      opset_version=11,
+                      do_constant_folding=True,
+                      input_names=['audio_sequences'] + feat_names,
+                      output_names=['output'],
+                      dynamic_axes={'audio_sequences': {0: 'batch_size'},
+                                    'output': {0: 'batch_size'}})
+
+    core = Core()
+    save_model(core.read_model(model=encoder_onnx_path), output_model="wav2lip_openvino_face_encoder.xml")
+    save_model(core.read_model(model=decoder_onnx_path), output_model="wav2lip_openvino_decoder.xml")
+    print("OpenVINO split models saved")
+
 if __name__ == '__main__':
     checkpoint_path = 'checkpoints/wav2lip_gan.pth'  # Path to your PyTorch checkpoint
     onnx_path = 'wav2lip_model.onnx'  # Path to save the ONNX model
@@ -1,6 +1,7 @@
 import torch
 from torch import nn
 from torch.nn import functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 class Conv2d(nn.Module):
     def __init__(self, cin, cout, kernel_size, stride, padding, residual=False, *args, **kwargs):
@@ -18,6 +19,12 @@ class Conv2d(nn.Module):
             out += x
         return self.act(out)
 
+    def fuse(self):
+        # Folds the BatchNorm into the convolution (eval statistics) and makes the ReLU in-place
+        if len(self.conv_block) == 2:
+            self.conv_block = nn.Sequential(fuse_conv_bn_eval(self.conv_block[0], self.conv_block[1]))
+        self.act = nn.ReLU(inplace=True)
+
 class nonorm_Conv2d(nn.Module):
     def __init__(self, cin, cout, kernel_size, stride, padding, residual=False, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -42,3 +49,21 @@ class Conv2dTranspose(nn.Module):
     def forward(self, x):
         out = self.conv_block(x)
         return self.act(out)
+
+    def fuse(self):
+        # Folds the BatchNorm into the transposed convolution (eval statistics) and makes the ReLU in-place
+        if len(self.conv_block) == 2:
+            self.conv_block = nn.Sequential(fuse_conv_bn_eval(self.conv_block[0], self.conv_block[1], transpose=True))
+        self.act = nn.ReLU(inplace=True)
+
+def fuse_for_inference(model):
+    """Prepares ``model`` for inference: puts it in eval mode and folds the BatchNorm of every
+    Conv2d / Conv2dTranspose block into its convolution, so each block runs one conv and an
+    in-place (residual add +) ReLU. The model is modified in place and returned; it can no
+    longer be trained or load checkpoints.
+    """
+    model.eval()
+    for module in model.modules():
+        if isinstance(module, (Conv2d, Conv2dTranspose)):
+            module.fuse()
+    return model
@@ -84,36 +84,46 @@ class Wav2Lip(nn.Module):
             nn.Conv2d(32, 3, kernel_size=1, stride=1, padding=0),
             nn.Sigmoid()) 
 
-    def forward(self, audio_sequences, face_sequences):
-        # audio_sequences = (B, T, 1, 80, 16)
-        B = audio_sequences.size(0)
-
-        input_dim_size = len(face_sequences.size())
-        if input_dim_size > 4:
-            audio_sequences = torch.cat([audio_sequences[:, i] for i in range(audio_sequences.size(1))], dim=0)
-            face_sequences = torch.cat([face_sequences[:, :, i] for i in range(face_sequences.size(2))], dim=0)
-
-        audio_embedding = self.audio_encoder(audio_sequences) # B, 512, 1, 1
-
+    def encode_face(self, face_sequences):
+        # Skip-connection feature maps of the face encoder, shallowest first.
+        # For a static avatar these only need to be computed once and can be reused with decode()
         feats = []
         x = face_sequences
         for f in self.face_encoder_blocks:
             x = f(x)
             feats.append(x)
+        return feats
+
+    def decode(self, audio_sequences, feats):
+        # feats come from encode_face(); feature maps with batch size 1 are broadcast to the audio batch
+        audio_embedding = self.audio_encoder(audio_sequences) # B, 512, 1, 1
+        B = audio_embedding.size(0)
 
         x = audio_embedding
-        for f in self.face_decoder_blocks:
+        for f, feat in zip(self.face_decoder_blocks, reversed(feats)):
             x = f(x)
+            if feat.size(0) != B:
+                feat = feat.expand(B, -1, -1, -1)
             try:
-                x = torch.cat((x, feats[-1]), dim=1)
+                x = torch.cat((x, feat), dim=1)
             except Exception as e:
                 print(x.size())
-                print(feats[-1].size())
+                print(feat.size())
                 raise e
-            
-            feats.pop()
 
-        x = self.output_block(x)
+        return self.output_block(x)
+
+    def forward(self, audio_sequences, face_sequences):
+        # audio_sequences = (B, T, 1, 80, 16)
+        B = audio_sequences.size(0)
+
+        input_dim_size = len(face_sequences.size())
+        if input_dim_size > 4:
+            audio_sequences = torch.cat([audio_sequences[:, i] for i in range(audio_sequences.size(1))], dim=0)
+            face_sequences = torch.cat([face_sequences[:, :, i] for i in range(face_sequences.size(2))], dim=0)
+
+        feats = self.encode_face(face_sequences)
+        x = self.decode(audio_sequences, feats)
 
         if input_dim_size > 4:
             x = torch.split(x, B, dim=0) # [(B, C, H, W)]
@@ -5,10 +5,6 @@ if sys.version_info[0] < 3 and sys.version_info[1] < 2:
 
 from os import listdir, path
 
-if not path.isfile('face_detection/detection/sfd/s3fd.pth'):
-	raise FileNotFoundError('Save the s3fd model to face_detection/detection/sfd/s3fd.pth \
-							before running this script!')
-
 import multiprocessing as mp
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
@@ -23,14 +19,30 @@ import face_detection
 parser = argparse.ArgumentParser()
 
 parser.add_argument('--ngpu', help='Number of GPUs across which to run in parallel', default=1, type=int)
-parser.add_argument('--batch_size', help='Single GPU Face detection batch size', default=32, type=int)
+parser.add_argument('--batch_size', help='Single GPU Face detection batch size. By default it is sized from the frame '
+					'resolution and free GPU memory, and halved whenever a batch runs out of memory', default=None, type=int)
 parser.add_argument("--data_root", help="Root folder of the LRS2 dataset", required=True)
 parser.add_argument("--preprocessed_root", help="Root folder of the preprocessed dataset", required=True)
+parser.add_argument('--detect_short_side', help='Run face detection on frames resized to this shorter side, '
+					'boxes are mapped back to full resolution', default=None, type=int)
+parser.add_argument('--refine_detections', help='Re-detect at full resolution around every downscaled detection',
+					action='store_true')
+parser.add_argument('--detector_dtype', help='Precision of the face detector, float16/bfloat16 also run it channels-last',
+					default='float32', choices=['float32', 'float16', 'bfloat16'])
+parser.add_argument('--detector', help='Face detector, see face_detection.load_detector', default='sfd',
+					choices=list(face_detection.DETECTORS))
 
 args = parser.parse_args()
 
+if args.detector == 'sfd' and not path.isfile('face_detection/detection/sfd/s3fd.pth'):
+	raise FileNotFoundError('Save the s3fd model to face_detection/detection/sfd/s3fd.pth \
+							before running this script!')
+
 fa = [face_detection.FaceAlignment(face_detection.LandmarksType._2D, flip_input=False, 
-									device='cuda:{}'.format(id)) for id in range(args.ngpu)]
+									device='cuda:{}'.format(id), face_detector=args.detector,
+									detector_dtype=args.detector_dtype) for id in range(args.ngpu)]
+batch_sizers = [face_detection.DetectionBatchSizer(fa[id].face_detector, 'cuda:{}'.format(id), batch_size=args.batch_size)
+				for id in range(args.ngpu)]
 
 template = 'ffmpeg -loglevel panic -y -i {} -strict -2 {}'
 # template2 = 'ffmpeg -hide_banner -loglevel panic -threads 1 -y -i {} -async 1 -ac 1 -vn -acodec pcm_s16le -ar 16000 {}'
@@ -52,19 +64,21 @@ def process_video_file(vfile, args, gpu_id):
 	fulldir = path.join(args.preprocessed_root, dirname, vidname)
 	os.makedirs(fulldir, exist_ok=True)
 
-	batches = [frames[i:i + args.batch_size] for i in range(0, len(frames), args.batch_size)]
+	if len(frames) == 0:
+		return
+	# Shape the detector sees, batches are sized from it
+	frame_shape = face_detection.detection_scale(frames[0].shape, args.detect_short_side)[1]
 
-	i = -1
-	for fb in batches:
-		preds = fa[gpu_id].get_detections_for_batch(np.asarray(fb))
+	detect = lambda fb: fa[gpu_id].get_detections_for_batch(np.asarray(fb), short_side=args.detect_short_side,
+															refine=args.refine_detections)
+	preds = batch_sizers[gpu_id].run(detect, frames, frame_shape=frame_shape)
 
-		for j, f in enumerate(preds):
-			i += 1
-			if f is None:
-				continue
+	for i, f in enumerate(preds):
+		if f is None:
+			continue
 
-			x1, y1, x2, y2 = f
-			cv2.imwrite(path.join(fulldir, '{}.jpg'.format(i)), fb[j][y1:y2, x1:x2])
+		x1, y1, x2, y2 = f
+		cv2.imwrite(path.join(fulldir, '{}.jpg'.format(i)), frames[i][y1:y2, x1:x2])
 
 def process_audio_file(vfile, args):
 	vidname = os.path.basename(vfile).split('.')[0]
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+import torch
+
+import audio
+from hparams import hparams as hp
+
+
+def _test_wav(dtype, seconds=1.3, seed=0):
+    rng = np.random.RandomState(seed)
+    t = np.arange(int(hp.sample_rate * seconds)) / hp.sample_rate
+    wav = 0.3 * np.sin(2 * np.pi * 220 * t) + 0.05 * rng.randn(len(t))
+    return wav.astype(dtype)
+
+
+@pytest.mark.parametrize('dtype, atol', [(np.float32, 1e-4), (np.float64, 1e-8)])
+def test_melspectrogram_batch_matches_melspectrogram(dtype, atol):
+    wavs = np.stack([_test_wav(dtype, seed=seed) for seed in range(3)])
+    expected = np.stack([audio.melspectrogram(wav) for wav in wavs])
+
+    mels = audio.melspectrogram_batch(wavs)
+
+    assert mels.dtype == (torch.float64 if dtype == np.float64 else torch.float32)
+    assert mels.shape == expected.shape
+    np.testing.assert_allclose(mels.numpy(), expected, rtol=0, atol=atol)
+
+
+def test_melspectrogram_batch_scales_int16():
+    wav = _test_wav(np.float32)
+    pcm = np.round(wav * 32767).astype(np.int16)
+    expected = audio.melspectrogram(pcm.astype(np.float32) / 32768.)
+
+    mel = audio.melspectrogram_batch(pcm[None])[0]
+
+    np.testing.assert_allclose(mel.numpy(), expected, rtol=0, atol=1e-4)
+
+
+def test_melspectrogram_batch_rejects_int64():
+    with pytest.raises(ValueError):
+        audio.melspectrogram_batch(np.zeros((1, hp.sample_rate), dtype=np.int64))
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+import torch
+
+from face_detection.detection.sfd.detect import to_network_input
+from face_detection.detection.sfd.net_s3fd import s3fd
+
+
+def _raw_outputs(net, imgs, dtype):
+    if dtype != torch.float32:
+        net = net.to(dtype=dtype, memory_format=torch.channels_last)
+    with torch.no_grad():
+        return [o.float() for o in net(to_network_input(imgs, 'cpu', dtype))]
+
+
+@pytest.mark.parametrize('dtype, tolerance', [(torch.float16, 1.5e-3), (torch.bfloat16, 1.1e-2)])
+def test_reduced_precision_s3fd_matches_float32(dtype, tolerance):
+    torch.manual_seed(0)
+    net = s3fd().eval()
+    imgs = np.random.RandomState(0).randint(0, 256, size=(2, 128, 160, 3), dtype=np.uint8)
+
+    expected = _raw_outputs(net, imgs, torch.float32)
+    outputs = _raw_outputs(net, imgs, dtype)
+
+    for out, ref in zip(outputs, expected):
+        assert out.shape == ref.shape
+        # Error relative to the output range, the scale box decoding and softmax see
+        error = (out - ref).abs().max() / (ref.max() - ref.min())
+        assert error < tolerance
@@ -0,0 +1,53 @@
+import copy
+
+import pytest
+import torch
+from torch import nn
+
+from models import Wav2Lip, SyncNet_color, fuse_for_inference
+
+
+def _randomize_batchnorm(model):
+    # Freshly initialized BatchNorm is the identity, give it trained-looking statistics
+    generator = torch.Generator().manual_seed(0)
+    for m in model.modules():
+        if isinstance(m, nn.BatchNorm2d):
+            n = m.num_features
+            m.running_mean.copy_(0.1 * torch.randn(n, generator=generator))
+            m.running_var.copy_(0.5 + torch.rand(n, generator=generator))
+            m.weight.data.copy_(1 + 0.1 * torch.randn(n, generator=generator))
+            m.bias.data.copy_(0.1 * torch.randn(n, generator=generator))
+    return model
+
+
+def _fused_pair(model):
+    torch.manual_seed(0)
+    model = _randomize_batchnorm(model).eval()
+    fused = fuse_for_inference(copy.deepcopy(model))
+    assert not any(isinstance(m, nn.BatchNorm2d) for m in fused.modules())
+    return model, fused
+
+
+@pytest.mark.parametrize('audio_shape, face_shape', [
+    ((2, 1, 80, 16), (2, 6, 96, 96)),
+    ((2, 5, 1, 80, 16), (2, 6, 5, 96, 96)),
+])
+@torch.no_grad()
+def test_fused_wav2lip_matches_unfused(audio_shape, face_shape):
+    model, fused = _fused_pair(Wav2Lip())
+    mels, faces = torch.randn(audio_shape), torch.rand(face_shape)
+
+    expected = model(mels, faces)
+    out = fused(mels, faces)
+
+    assert out.shape == expected.shape
+    torch.testing.assert_close(out, expected, rtol=1e-4, atol=1e-5)
+
+
+@torch.no_grad()
+def test_fused_syncnet_matches_unfused():
+    model, fused = _fused_pair(SyncNet_color())
+    mels, faces = torch.randn(2, 1, 80, 16), torch.rand(2, 15, 48, 96)
+
+    for out, expected in zip(fused(mels, faces), model(mels, faces)):
+        torch.testing.assert_close(out, expected, rtol=1e-4, atol=1e-5)
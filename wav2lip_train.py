@@ -84,19 +84,14 @@ class Dataset(object):
         return spec[start_idx : end_idx, :]
 
     def get_segmented_mels(self, spec, start_frame):
-        mels = []
         assert syncnet_T == 5
         start_frame_num = self.get_frame_id(start_frame) + 1 # 0-indexing ---> 1-indexing
         if start_frame_num - 2 < 0: return None
-        for i in range(start_frame_num, start_frame_num + syncnet_T):
-            m = self.crop_audio_window(spec, i - 2)
-            if m.shape[0] != syncnet_mel_step_size:
-                return None
-            mels.append(m.T)
-
-        mels = np.asarray(mels)
+        # Same start indices as crop_audio_window(spec, i - 2) for each of the syncnet_T frames
+        frame_nums = np.arange(start_frame_num - 2, start_frame_num - 2 + syncnet_T)
+        starts = (80. * (frame_nums / float(hparams.fps))).astype(np.int64)
 
-        return mels
+        return audio.gather_mel_windows(spec.T, starts, syncnet_mel_step_size)
 
     def prepare_window(self, window):
         # 3 x T x H x W
@@ -136,18 +131,16 @@ class Dataset(object):
 
             try:
                 wavpath = join(vidname, "audio.wav")
-                wav = audio.load_wav(wavpath, hparams.sample_rate)
-
-                orig_mel = audio.melspectrogram(wav).T
+                orig_mel = audio.cached_melspectrogram(wavpath).T
             except Exception as e:
                 continue
 
-            mel = self.crop_audio_window(orig_mel.copy(), img_name)
+            mel = self.crop_audio_window(orig_mel, img_name)
             
             if (mel.shape[0] != syncnet_mel_step_size):
                 continue
 
-            indiv_mels = self.get_segmented_mels(orig_mel.copy(), img_name)
+            indiv_mels = self.get_segmented_mels(orig_mel, img_name)
             if indiv_mels is None: continue
 
             window = self.prepare_window(window)